@@ -1,12 +1,92 @@
 import thread
+import threading
+import copy
 import numpy
 import logging
 import cdo
+import netCDF4
 import os
+from collections import OrderedDict
+
+from ece2cmor3 import grib_file
 
 # Log object
 log = logging.getLogger(__name__)
 
+# Cache of file metadata queries, keyed by path, modification time, size and query. The least recently used entries
+# are evicted when the cache exceeds its maximal size.
+metadata_cache = OrderedDict()
+metadata_cache_size = 1024
+metadata_lock = threading.Lock()
+
+# Grib level types per cdo z-axis type
+zaxis_level_types = {"pressure": [grib_file.pressure_level_hPa_code, grib_file.pressure_level_Pa_code, 99],
+                     "height": [grib_file.height_level_code], "hybrid": [grib_file.hybrid_level_code],
+                     "surface": [grib_file.surface_level_code]}
+
+
+# Returns the result of the metadata query on the file at path, computed by func if it is not cached
+def query_metadata(path, query, func):
+    try:
+        stats = os.stat(path)
+    except OSError:
+        return func()
+    key = (path, stats.st_mtime, stats.st_size, query)
+    with metadata_lock:
+        if key in metadata_cache:
+            result = metadata_cache.pop(key)
+            metadata_cache[key] = result
+            return copy.copy(result)
+    result = func()
+    if result is None:
+        return None
+    with metadata_lock:
+        metadata_cache[key] = result
+        while len(metadata_cache) > metadata_cache_size:
+            metadata_cache.popitem(last=False)
+    return copy.copy(result)
+
+
+# Sets the code attribute and the name of the single data variable in the netcdf file, like a conversion from grib
+# does. Returns false if the file does not contain a single data variable.
+def set_netcdf_code(path, codes):
+    global log
+    if len(codes) != 1:
+        return False
+    code = int(codes[0])
+    try:
+        dataset = netCDF4.Dataset(path, 'a')
+    except (IOError, RuntimeError) as e:
+        log.error("Could not open netcdf file %s to set variable code, reason: %s" % (path, str(e)))
+        return False
+    try:
+        bounds = set([getattr(v, "bounds", None) for v in dataset.variables.values()])
+        names = [n for n, v in dataset.variables.iteritems() if n not in dataset.dimensions and n not in bounds and
+                 len(v.dimensions) > 1]
+        if len(names) != 1:
+            return False
+        dataset.variables[names[0]].setncattr("code", numpy.int32(code))
+        name = "var" + str(code)
+        if names[0] != name and name not in dataset.variables:
+            dataset.renameVariable(names[0], name)
+        return True
+    finally:
+        dataset.close()
+
+
+# Returns the code, level type and level of all messages in the grib file, or None if it cannot be read
+def read_grib_levels(path):
+    try:
+        return [(get_cdo_code(row[4]), row[5], row[6]) for row in grib_file.create_index(path)]
+    except Exception as e:
+        log.warning("Could not read grib headers of file %s natively, reason: %s" % (path, str(e)))
+        return None
+
+
+# Converts the grib parameter id to the code used by cdo
+def get_cdo_code(param):
+    return param if param < 256 else param % 1000
+
 
 # Class for interfacing with the CDO python wrapper.
 class cdo_command:
@@ -72,6 +152,7 @@ class cdo_command:
     # Constructor
     def __init__(self, code=0):
         self.operators = {}
+        self.order = None
         self.app = cdo.Cdo()
         if code > 0:
             self.add_operator(cdo_command.select_code_operator, code)
@@ -87,10 +168,17 @@ class cdo_command:
         else:
             log.error("Unknown operator was rejected: ", operator)
 
+    # Returns the operators in the order of the command string, i.e. the last operator is applied first. An explicitly
+    # set order overrides the optimized default ordering.
+    def get_operator_keys(self):
+        if self.order is not None:
+            return list(self.order)
+        return cdo_command.optimize_order(
+            sorted(self.operators.keys(), key=lambda op: cdo_command.operator_ordering.index(op)))
+
     # Creates a command string from the given operator list
     def create_command(self):
-        keys = cdo_command.optimize_order(
-            sorted(self.operators.keys(), key=lambda op: cdo_command.operator_ordering.index(op)))
+        keys = self.get_operator_keys()
         return " ".join([cdo_command.make_option(k, self.operators[k]) for k in keys])
 
     def merge(self, ifiles, ofile):
@@ -98,18 +186,32 @@ class cdo_command:
             return self.app.merge(input=ifiles, output=ofile)
         return self.app.merge(input=' '.join(ifiles), output=ofile)
 
+    # Returns an input string that merges the input files within a cdo command, instead of merging them to disk first
+    @staticmethod
+    def merge_input(ifiles):
+        return " ".join(["-" + cdo_command.merge_operator] + list(ifiles))
+
     def show_code(self, ifile):
         return self.app.showcode(input=ifile)
 
-    # Applies the current set of operators to the input file.
-    def apply(self, ifile, ofile=None, threads=4, grib_first=False):
+    # Applies the current set of operators to the input file. The output is written in netcdf format, unless
+    # grib_output is set, in which case the format of the input is kept. With grib_first, the variable codes are set as
+    # in grib output: the netcdf output is written in a single pass and its variable is given the code of the setcode
+    # operator. Only if that fails, a grib file is written and converted to netcdf.
+    def apply(self, ifile, ofile=None, threads=4, grib_first=False, grib_output=False, precision=None):
         global log
-        keys = cdo_command.optimize_order(
-            sorted(self.operators.keys(), key=lambda op: cdo_command.operator_ordering.index(op)))
+        if grib_first and not grib_output and ofile:
+            result = self.apply(ifile, ofile, threads)
+            if result is None or set_netcdf_code(ofile, self.operators.get(cdo_command.set_code_operator, [])):
+                return result
+            log.warning("Could not set the variable code in %s, converting from grib output instead" % ofile)
+        keys = self.get_operator_keys()
         option_string = "-f nc" if threads < 2 else ("-f nc -P " + str(threads))
-        if grib_first:
+        if grib_first or grib_output:
             option_string = "" if threads < 2 else ("-P " + str(threads))
-        func = getattr(self.app, keys[0], None)
+        if precision is not None:
+            option_string = " ".join(filter(None, [option_string, "-b " + precision]))
+        func = getattr(self.app, keys[0], None) if any(keys) else None
         app_args = None
         if func:
             app_args = ",".join([str(a) for a in self.operators.get(keys[0], [])])
@@ -118,7 +220,7 @@ class cdo_command:
             func = getattr(self.app, "copy")
             input_string = " ".join([cdo_command.make_option(k, self.operators[k]) for k in keys] + [ifile])
         output_file = ofile
-        if ofile and grib_first:
+        if ofile and grib_first and not grib_output:
             output_file = ofile[:-3] + ".grib"
         try:
             if app_args and ofile:
@@ -129,7 +231,7 @@ class cdo_command:
                 f = func(input=input_string, output=output_file, options=option_string)
             else:
                 f = func(input=input_string, options=option_string)
-            if grib_first:
+            if grib_first and not grib_output:
                 option_string = "-f nc"
                 self.app.copy(input=output_file, output=ofile, options=option_string)
                 os.remove(output_file)
@@ -138,12 +240,13 @@ class cdo_command:
             return None
         return f
 
-    # Applies the current set of operators and returns the netcdf variables in memory:
+    # Applies the current set of operators and returns the opened netcdf dataset. The output is not streamed: python-cdo
+    # still writes a netcdf file, in its own temporary directory instead of an output path given by the caller. The
+    # file is removed when the dataset is released.
     def apply_cdf(self, ifile, threads=4):
-        keys = cdo_command.optimize_order(
-            sorted(self.operators.keys(), key=lambda op: cdo_command.operator_ordering.index(op)))
-        option_string = "" if threads < 2 else ("-P " + str(threads))
-        func = getattr(self.app, keys[0], None)
+        keys = self.get_operator_keys()
+        option_string = "-f nc" if threads < 2 else ("-f nc -P " + str(threads))
+        func = getattr(self.app, keys[0], None) if any(keys) else None
         app_args = None
         if func:
             app_args = ",".join([str(a) for a in self.operators.get(keys[0], [])])
@@ -153,15 +256,19 @@ class cdo_command:
             input_string = " ".join([cdo_command.make_option(k, self.operators[k]) for k in keys] + [ifile])
         try:
             if app_args:
-                return func(app_args, input=input_string, options=option_string, returnCdf=True).variables
+                return func(app_args, input=input_string, options=option_string, returnCdf=True)
             else:
-                return func(input=input_string, options=option_string, returnCdf=True).variables
+                return func(input=input_string, options=option_string, returnCdf=True)
         except cdo.CDOException as e:
             log.error(str(e))
             return None
 
-    # Grid description method
+    # Grid description method, the result is cached per file
     def get_grid_descr(self, ifile):
+        return query_metadata(ifile, "griddes", lambda: self.read_grid_descr(ifile))
+
+    # Reads the grid description with cdo
+    def read_grid_descr(self, ifile):
         global log
         int_fields = ["gridsize", "np", "xsize", "ysize"]
         real_fields = ["xfirst", "xinc", "yfirst", "yinc"]
@@ -209,6 +316,14 @@ class cdo_command:
     def get_z_axes(self, ifile, var):
         if not ifile:
             return []
+        return query_metadata(ifile, "showltype " + str(var), lambda: self.read_z_axes(ifile, var))
+
+    # Reads the vertical axes of the input variable, grib files are read natively
+    def read_z_axes(self, ifile, var):
+        if isinstance(var, int):
+            levels = query_metadata(ifile, "levels", lambda: read_grib_levels(ifile))
+            if levels is not None:
+                return sorted(set([levtype for code, levtype, level in levels if code == var]))
         select_operator = cdo_command.select_code_operator if isinstance(var, int) else cdo_command.select_var_operator
         try:
             output = self.app.showltype(input=" ".join([cdo_command.make_option(select_operator, [var]), ifile]))
@@ -223,6 +338,23 @@ class cdo_command:
     def get_levels(self, ifile, var, axis):
         if not ifile:
             return []
+        return query_metadata(ifile, "showlevel %s %s" % (str(var), axis),
+                              lambda: self.read_levels(ifile, var, axis))
+
+    # Reads the levels of the input variable and axis, grib files are read natively and pressure levels are returned in
+    # Pa like cdo does
+    def read_levels(self, ifile, var, axis):
+        if isinstance(var, int) and axis in zaxis_level_types:
+            levels = query_metadata(ifile, "levels", lambda: read_grib_levels(ifile))
+            if levels is not None:
+                result = []
+                for code, levtype, level in levels:
+                    if code != var or levtype not in zaxis_level_types[axis]:
+                        continue
+                    value = 100. * level if levtype == grib_file.pressure_level_hPa_code else float(level)
+                    if value not in result:
+                        result.append(value)
+                return result
         select_operator = cdo_command.select_code_operator if isinstance(var, int) else cdo_command.select_var_operator
         selvar_operator = cdo_command.make_option(select_operator, [var])
         selzaxis_operator = cdo_command.make_option(cdo_command.select_z_operator, [axis])
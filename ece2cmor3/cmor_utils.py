@@ -16,12 +16,23 @@ import netCDF4
 import numpy
 import os
 import re
+import threading
+
+from collections import OrderedDict
 
 # Log object
-from ece2cmor3 import components
+from ece2cmor3 import components, cdoapi
 
 log = logging.getLogger(__name__)
 
+# Memory budget in bytes for writing arrays to cmor, shared by all components. When not set, the environment variable
+# ECE2CMOR3_MEMORY_MB is used, falling back to the default of 4 GB.
+memory_budget = None
+memory_budget_default = 4.0E+9
+
+# Number of values masked and rescaled per block in apply_mask
+mask_block_size = 2 ** 20
+
 
 # Enum utility class
 class cmor_enum(tuple):
@@ -91,6 +102,26 @@ def make_cmor_frequency(s):
     raise Exception("Could not convert argument", s, "to a relative time interval")
 
 
+# Maps each time interval (lower, upper) to the index of the first time stamp within it, or -1 if no time stamp falls
+# within the interval
+def get_time_slice_map(time_stamps, bounds):
+    times = numpy.array(time_stamps, dtype="datetime64[us]")
+    lower = numpy.array([b[0] for b in bounds], dtype="datetime64[us]")
+    upper = numpy.array([b[1] for b in bounds], dtype="datetime64[us]")
+    order = numpy.argsort(times, kind="mergesort")
+    sorted_times = times[order]
+    first = numpy.searchsorted(sorted_times, lower, side="left")
+    last = numpy.searchsorted(sorted_times, upper, side="right")
+    result = numpy.full(len(bounds), -1, dtype=numpy.int64)
+    valid = last > first
+    if numpy.array_equal(order, numpy.arange(len(times))):
+        result[valid] = first[valid]
+    else:
+        for i in numpy.nonzero(valid)[0]:
+            result[i] = order[first[i]:last[i]].min()
+    return result
+
+
 # Creates a time interval from the input string, assuming ec-earth conventions
 def get_rounded_time(freq, time, offset=0):
     interval = make_cmor_frequency(freq)
@@ -189,12 +220,37 @@ def get_nemo_frequency(filepath, expname):
     return fstr
 
 
+# Reads the time stamps in the file, netcdf files are read natively and the result is cached per file
 def read_time_stamps(path):
+    return cdoapi.query_metadata(path, "showtimestamp", lambda: read_file_time_stamps(path))
+
+
+def read_file_time_stamps(path):
+    try:
+        ds = netCDF4.Dataset(path, 'r')
+    except Exception:
+        ds = None
+    if ds is not None:
+        try:
+            if "time" in ds.variables:
+                return read_netcdf_time_stamps(ds.variables["time"])
+        finally:
+            ds.close()
     command = cdo.Cdo()
     times = command.showtimestamp(input=path)[0].split()
     return map(lambda s: datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%S"), times)
 
 
+# Converts the netcdf time variable to date times, rounded to seconds
+def read_netcdf_time_stamps(time_var):
+    dates = netCDF4.num2date(time_var[:], time_var.units, getattr(time_var, "calendar", "standard"))
+    result = []
+    for d in numpy.atleast_1d(dates):
+        t = datetime.datetime(d.year, d.month, d.day, d.hour, d.minute, d.second, getattr(d, "microsecond", 0))
+        result.append((t + datetime.timedelta(microseconds=500000)).replace(microsecond=0))
+    return result
+
+
 def find_tm5_output(path, expname=None, varname=None, freq=None):
     """
     Finds TM5 outputfiles, which consist of varname + "_" + "AER"[freq] + * + dates + ".nc"
@@ -277,158 +333,344 @@ def get_tm5_interval(filepath):
     return start, end
 
 
-# Writes the ncvar (numpy array or netcdf variable) to CMOR variable with id varid
+# Returns the memory budget in bytes for writing data to cmor
+def get_memory_budget():
+    global memory_budget
+    if memory_budget is not None:
+        return memory_budget
+    env_val = os.environ.get("ECE2CMOR3_MEMORY_MB", None)
+    if env_val is None:
+        return memory_budget_default
+    try:
+        return max(1, int(env_val)) * 2 ** 20
+    except ValueError:
+        log.error("Could not interpret environment variable ECE2CMOR3_MEMORY_MB with value %s as integer" % env_val)
+        return memory_budget_default
+
+
+# Returns the number of bytes per value that reading the given variable produces
+def get_itemsize(ncvar):
+    dtype = getattr(ncvar, "dtype", None)
+    try:
+        itemsize = numpy.dtype(dtype).itemsize if dtype is not None else 8
+    except TypeError:
+        itemsize = 8
+    for attr in ["scale_factor", "add_offset"]:
+        if hasattr(ncvar, attr):
+            itemsize = max(itemsize, numpy.asarray(getattr(ncvar, attr)).dtype.itemsize)
+    return itemsize
+
+
+# Returns the number of bytes needed to write a single time step of size values with the given item size: the values
+# read, ntemps temporaries of the same type (the rescaled values and the contiguous copy passed to cmor) and a boolean
+# mask.
+def get_step_bytes(size, itemsize, ntemps=2):
+    return size * (itemsize * (1 + ntemps) + 1)
+
+
+# Returns the number of time steps that can be written at once within the memory budget
+def get_chunk_size(step_bytes):
+    if step_bytes <= 0:
+        return 1
+    return max(1, int(math.floor(get_memory_budget() / float(step_bytes))))
+
+
+# Writes the ncvar (numpy array or netcdf variable) to CMOR variable with id varid, in chunks of time steps that fit in
+# the memory budget
 def netcdf2cmor(varid, ncvar, timdim=0, factor=1.0, term=0.0, psvarid=None, ncpsvar=None, swaplatlon=False,
                 fliplat=False, mask=None, missval=1.e+20, time_selection=None, force_fx=False):
     global log
     ndims = len(ncvar.shape)
+    if ndims < 1 or ndims > 5:
+        log.error("Cmorizing arrays of rank %d is not supported" % ndims)
+        return
+    if not (timdim == 0 or timdim == ndims - 1 or (timdim < 0 and ndims <= 3)):
+        log.error("Unsupported array structure with %d dimensions and time dimension index %d" % (ndims, timdim))
+        return
     if timdim < 0:
         ntimes = 1 if time_selection is None else len(time_selection)
     else:
         ntimes = ncvar.shape[timdim] if time_selection is None else len(time_selection)
-    size = ncvar.size / ntimes
-    chunk = int(math.floor(4.0E+9 / (8 * size)))  # Use max 4 GB of memory
-    if time_selection is not None and numpy.any(time_selection < 0):
-        chunk = 1
+    size = ncvar.size if timdim < 0 else ncvar.size / ntimes
+    # Constant fields are read once, every time step only costs its copy in the repeated block passed to cmor
+    step_bytes = get_step_bytes(size, get_itemsize(ncvar), ntemps=0 if timdim < 0 else 2)
+    if psvarid is not None and ncpsvar is not None and len(ncpsvar.shape) > 1:
+        step_bytes += get_step_bytes(numpy.prod(ncpsvar.shape[-2:]), get_itemsize(ncpsvar), ntemps=1)
+    chunk = get_chunk_size(step_bytes)
+    log.debug("Writing %d time steps in chunks of %d within a memory budget of %.1f MB" %
+              (ntimes, chunk, get_memory_budget() / 2. ** 20))
+    peak_bytes = 0
     missval_in = getattr(ncvar, "missing_value", None)
-    for i in range(0, ntimes, chunk):
-        imax = min(i + chunk, ntimes)
-        time_slice = slice(i, imax, 1)
-        if time_selection is not None:
-            if numpy.array_equal(time_selection[i: imax], numpy.arange(i, imax)):
-                time_slice = slice(i, imax, 1)
-            elif numpy.array_equal(time_selection[i: imax], numpy.array([-1])):
-                time_slice = None
-            else:
-                time_slice = time_selection[i: imax]
-        vals = None
-        if ndims == 1:
-            if timdim < 0:
-                vals = apply_mask(ncvar[:], factor, term, None, missval_in, missval)
-            elif timdim == 0:
-                vals = apply_mask(ncvar[i:imax], factor, term, None, missval_in, missval)
-        elif ndims == 2:
-            if timdim < 0:
-                if swaplatlon:
-                    vals = (apply_mask(ncvar[:, :], factor, term, mask, missval_in, missval)).transpose()
-                else:
-                    vals = apply_mask(ncvar[:, :], factor, term, mask, missval_in, missval)
-            elif timdim == 0:
-                if time_slice is None:
-                    vals = numpy.transpose(numpy.full((1,) + ncvar.shape[1:], missval), axes=[1, 0])
-                else:
-                    vals = numpy.transpose(apply_mask(ncvar[time_slice, :], factor, term, None, missval_in,
-                                                      missval), axes=[1, 0])
-            elif timdim == 1:
-                if time_slice is None:
-                    vals = numpy.full(ncvar.shape[:-1] + (1,), missval)
-                else:
-                    vals = apply_mask(ncvar[:, time_slice], factor, term, None, missval_in, missval)
-        elif ndims == 3:
-            if timdim < 0:
-                vals = numpy.transpose(apply_mask(ncvar[:, :, :], factor, term, mask, missval_in, missval),
-                                       axes=[2, 1, 0] if swaplatlon else [1, 2, 0])
-            elif timdim == 0:
-                if time_slice is None:
-                    vals = numpy.transpose(numpy.full((1,) + ncvar.shape[1:], missval),
-                                           axes=[2, 1, 0] if swaplatlon else [1, 2, 0])
-                else:
-                    vals = numpy.transpose(apply_mask(ncvar[time_slice, :, :], factor, term, mask,
-                                                      missval_in, missval),
-                                           axes=[2, 1, 0] if swaplatlon else [1, 2, 0])
-            elif timdim == 2:
-                if mask is not None:
-                    log.error("Masking column-major stored arrays is not implemented yet...ignoring mask")
-                if time_slice is None:
-                    vals = numpy.transpose(numpy.full(ncvar.shape[:-1] + (1,), missval),
-                                           axes=[1, 0, 2] if swaplatlon else [0, 1, 2])
-                else:
-                    vals = numpy.transpose(apply_mask(ncvar[:, :, time_slice], factor, term, None, missval_in,
-                                                      missval),
-                                           axes=[1, 0, 2] if swaplatlon else [0, 1, 2])
-            else:
-                log.error("Unsupported array structure with 3 dimensions and time dimension index 1")
-                return
-        elif ndims == 4:
-            if timdim == 0:
-                if time_slice is None:
-                    vals = numpy.transpose(numpy.full((1,) + ncvar.shape[1:], missval),
-                                           axes=[3, 2, 1, 0] if swaplatlon else [2, 3, 1, 0])
-                else:
-                    vals = numpy.transpose(apply_mask(ncvar[time_slice, :, :, :], factor, term, mask, missval_in,
-                                                      missval),
-                                           axes=[3, 2, 1, 0] if swaplatlon else [2, 3, 1, 0])
-            elif timdim == 3:
-                if mask is not None:
-                    log.error("Masking column-major stored arrays is not implemented yet...ignoring mask")
-                if time_slice is None:
-                    vals = numpy.transpose(numpy.full(ncvar.shape[:-1] + (1,), missval),
-                                           axes=[1, 0, 2, 3] if swaplatlon else [0, 1, 2, 3])
-                else:
-                    vals = numpy.transpose(apply_mask(ncvar[:, :, :, time_slice], factor, term, mask, missval_in,
-                                                      missval),
-                                           axes=[1, 0, 2, 3] if swaplatlon else [0, 1, 2, 3])
-            else:
-                log.error("Unsupported array structure with 4 dimensions and time dimension index %d" % timdim)
-                return
-        elif ndims == 5:
-            if timdim == 0:
-                if time_slice is None:
-                    vals = numpy.transpose(numpy.full((1,) + ncvar.shape[1:], missval),
-                                           axes=[4, 3, 2, 1, 0] if swaplatlon else [3, 4, 2, 1, 0])
-                else:
-                    vals = numpy.transpose(apply_mask(ncvar[time_slice, :, :, :, :], factor, term, mask, missval_in,
-                                                      missval),
-                                           axes=[4, 3, 2, 1, 0] if swaplatlon else [3, 4, 2, 1, 0])
-            elif timdim == 4:
-                if mask is not None:
-                    log.error("Masking column-major stored arrays is not implemented yet...ignoring mask")
-                if time_slice is None:
-                    vals = numpy.transpose(numpy.full(ncvar.shape[:-1] + (1,), missval),
-                                           axes=[1, 0, 2, 3, 4] if swaplatlon else [0, 1, 2, 3, 4])
-                else:
-                    vals = numpy.transpose(apply_mask(ncvar[:, :, :, :, time_slice], factor, term, mask, missval_in,
-                                                      missval),
-                                           axes=[1, 0, 2, 3, 4] if swaplatlon else [0, 1, 2, 3, 4])
-            else:
-                log.error("Unsupported array structure with 4 dimensions and time dimension index %d" % timdim)
-                return
+    axes = get_cmor_axes(ndims, timdim, swaplatlon)
+    flipdim = axes[0] if fliplat and (ndims > 1 or timdim < 0) else None
+    invmask = None
+    if mask is not None and (ndims - (1 if timdim >= 0 else 0)) >= 2:
+        if 0 < timdim:
+            log.error("Masking column-major stored arrays is not implemented yet...ignoring mask")
         else:
-            log.error("Cmorizing arrays of rank %d is not supported" % ndims)
-            return
-        if fliplat and (ndims > 1 or timdim < 0):
-            vals = numpy.flipud(vals)
+            invmask = numpy.logical_not(mask)
+            if flipdim is not None and flipdim - ndims >= -invmask.ndim:
+                invmask = numpy.flip(invmask, axis=flipdim - ndims)
+            # The mask is applied after the transposition, so it is brought in the cmor axis order as well
+            invmask = numpy.transpose(invmask.reshape((1,) * (ndims - invmask.ndim) + invmask.shape), axes)
+    fx_vals, fx_blocks = None, {}
+    if timdim < 0:
+        fx_vals = read_chunk(ncvar, timdim, 0, 1, slice(None), axes, flipdim, factor, term, invmask, missval_in,
+                             missval)
+        # The selection does not matter for constant fields, the same values are written for every time step
+        time_selection = None
+    for i, imax, time_slice in get_time_runs(time_selection, ntimes, chunk):
         if timdim < 0 and ntimes > 1:
-            vals = numpy.repeat(vals, repeats=(imax - i), axis=ndims - 1)
+            # Constant fields are repeated over the time steps of the chunk in a single block, which is reused for all
+            # chunks of the same length
+            if imax - i not in fx_blocks:
+                fx_blocks[imax - i] = numpy.repeat(fx_vals[..., numpy.newaxis], imax - i, axis=-1)
+            vals = fx_blocks[imax - i]
+        elif timdim < 0:
+            vals = fx_vals
+        else:
+            vals = read_chunk(ncvar, timdim, i, imax, time_slice, axes, flipdim, factor, term, invmask, missval_in,
+                              missval)
+        spvals = None
+        if psvarid is not None and ncpsvar is not None:
+            spvals = read_ps_chunk(ncpsvar, i, imax, swaplatlon, fliplat)
+        chunk_bytes = (imax - i) * step_bytes if timdim >= 0 else \
+            get_step_bytes(fx_vals.size, fx_vals.dtype.itemsize) + sum([b.nbytes for b in fx_blocks.values()])
+        peak_bytes = max(peak_bytes, chunk_bytes)
+        log.debug("Writing time steps %d to %d, estimated peak memory %.1f MB" % (i, imax, chunk_bytes / 2. ** 20))
         ntimes_passed = 0 if ((timdim < 0 and ntimes == 1) or force_fx) else (imax - i)
         cmor.write(varid, vals, ntimes_passed=ntimes_passed)
         del vals
-        if psvarid is not None and ncpsvar is not None:
-            spvals = None
-            if len(ncpsvar.shape) == 3:
-                spvals = numpy.transpose(ncpsvar[i:imax, :, :], axes=[2, 1, 0] if swaplatlon else [1, 2, 0])
-            elif len(ncpsvar.shape) == 4:
-                projvar = ncpsvar[i:imax, 0, :, :]
-                spvals = numpy.transpose(projvar, axes=[2, 1, 0] if swaplatlon else [1, 2, 0])
-            if spvals is not None:
-                if fliplat:
-                    spvals = numpy.flipud(spvals)
-                cmor.write(psvarid, spvals, ntimes_passed=ntimes_passed, store_with=varid)
-                del spvals
-
-
-# Replaces missing values and applies the mask to the 2 trailing dimensions of the input array
-def apply_mask(array, factor, term, mask, missval_in, missval_out):
+        if spvals is not None:
+            cmor.write(psvarid, spvals, ntimes_passed=ntimes_passed, store_with=varid)
+            del spvals
+    log.info("Estimated peak memory for writing %d time steps in chunks of %d: %.1f MB" %
+             (ntimes, chunk, peak_bytes / 2. ** 20))
+
+
+# Returns the permutation of the input axes to the cmor axis order. For row-major input (time first or absent) these
+# are the two trailing axes (swapped if requested), the remaining spatial axes in reverse order and the time axis. For
+# column-major input (time last) the axes keep their order, apart from the optional swap of the first two.
+def get_cmor_axes(ndims, timdim, swaplatlon):
+    spatial = [d for d in range(ndims) if d != timdim]
+    if 0 < timdim:
+        head = spatial[1::-1] + spatial[2:] if swaplatlon else spatial
+    elif len(spatial) >= 2:
+        head = (spatial[:-3:-1] if swaplatlon else spatial[-2:]) + spatial[-3::-1]
+    else:
+        head = spatial
+    return head + ([timdim] if timdim >= 0 else [])
+
+
+# Reads the time steps i to imax of ncvar and returns them masked and rescaled as a contiguous array in the cmor axis
+# order, the inverted mask must be given in that order too. The latitude flip is done by reading with a negative
+# stride. The netcdf library returns the slab in the order of the file, so unless that is the cmor order, the
+# transposed copy is a second one. Arrays in memory are read as views and copied once, directly in cmor order.
+def read_chunk(ncvar, timdim, i, imax, time_slice, axes, flipdim, factor, term, invmask, missval_in, missval):
+    ndims = len(ncvar.shape)
+    if timdim >= 0 and time_slice is None:
+        shape = list(ncvar.shape)
+        shape[timdim] = imax - i
+        return numpy.full([shape[a] for a in axes], missval)
+    index = [slice(None)] * ndims
+    if timdim >= 0:
+        index[timdim] = time_slice
+    if flipdim is not None:
+        index[flipdim] = slice(None, None, -1)
+    return numpy.ascontiguousarray(apply_mask(get_cmor_order(ncvar[tuple(index)], axes), factor, term, None,
+                                              missval_in, missval, invmask))
+
+
+# Reads the time steps i to imax of the surface pressure variable in cmor axis order
+def read_ps_chunk(ncpsvar, i, imax, swaplatlon, fliplat):
+    if len(ncpsvar.shape) not in [3, 4]:
+        return None
+    axes = get_cmor_axes(3, 0, swaplatlon)
+    index = [slice(i, imax)] + ([0] if len(ncpsvar.shape) == 4 else []) + [slice(None), slice(None)]
+    if fliplat:
+        index[axes[0] - 3] = slice(None, None, -1)
+    return get_cmor_order(ncpsvar[tuple(index)], axes)
+
+
+# Returns the values transposed to the given axes as a contiguous array that can be modified. The values are only
+# copied if they are not contiguous in that order or if they are a view, e.g. of an array in memory.
+def get_cmor_order(vals, axes):
+    result = numpy.transpose(vals, axes)
+    if result.flags.c_contiguous and vals.flags.owndata:
+        return result
+    return result.copy(order='C')
+
+
+# Splits the time selection into runs of at most chunk time steps that are either missing or present in the input.
+# Returns the start and end of each run and the time slice to read: a slice if the run is contiguous in the input, an
+# index array otherwise, and None for missing time steps.
+def get_time_runs(time_selection, ntimes, chunk):
+    if time_selection is None:
+        return [(i, min(i + chunk, ntimes), slice(i, min(i + chunk, ntimes), 1)) for i in range(0, ntimes, chunk)]
+    missing = time_selection[:ntimes] < 0
+    breaks = numpy.nonzero(missing[1:] != missing[:-1])[0] + 1
+    result = []
+    for start, end in zip(numpy.append(0, breaks), numpy.append(breaks, ntimes)):
+        for i in range(start, end, chunk):
+            imax = min(i + chunk, end)
+            selection = time_selection[i:imax]
+            if missing[i]:
+                result.append((i, imax, None))
+            elif numpy.array_equal(selection, numpy.arange(selection[0], selection[0] + imax - i)):
+                result.append((i, imax, slice(selection[0], selection[0] + imax - i, 1)))
+            else:
+                result.append((i, imax, selection))
+    return result
+
+
+# Replaces missing values and applies the mask to the 2 trailing dimensions of the input array. Floating point arrays
+# are processed in place, block by block along the leading axis, with two reused boolean buffers instead of full-size
+# temporaries. The inverted mask can be passed to avoid recomputing it for every chunk, in any shape that broadcasts
+# to the array.
+def apply_mask(array, factor, term, mask, missval_in, missval_out, invmask=None):
+    if invmask is None and mask is not None:
+        invmask = numpy.logical_not(mask)
+    rescale = factor != 1.0 or term != 0.0
+    if missval_in is None and invmask is None and not rescale:
+        return array
+    if isinstance(array, numpy.ma.MaskedArray) or not numpy.issubdtype(array.dtype, numpy.floating) or \
+            array.ndim == 0:
+        return apply_mask_unfused(array, factor, term, invmask, missval_in, missval_out)
+    new_miss_val = array.dtype.type(missval_out)
+    if invmask is not None:
+        invmask = numpy.broadcast_to(invmask, array.shape)
+    step = max(1, mask_block_size // max(1, array[0].size))
+    missing = numpy.empty((min(step, array.shape[0]),) + array.shape[1:], dtype=bool)
+    buf = numpy.empty(missing.shape, dtype=bool)
+    for i in range(0, array.shape[0], step):
+        block = array[i:i + step]
+        n = block.shape[0]
+        block_missing, block_buf = missing[:n], buf[:n]
+        numpy.equal(block, new_miss_val, out=block_missing)
+        if missval_in is not None:
+            numpy.equal(block, missval_in, out=block_buf)
+            numpy.logical_or(block_missing, block_buf, out=block_missing)
+        if invmask is not None:
+            numpy.logical_or(block_missing, invmask[i:i + step], out=block_missing)
+        if rescale:
+            # Missing values are rescaled too, but overwritten below
+            with numpy.errstate(over="ignore", invalid="ignore"):
+                if factor != 1.0:
+                    numpy.multiply(block, factor, out=block)
+                numpy.add(block, term, out=block)
+        numpy.copyto(block, new_miss_val, where=block_missing)
+    return array
+
+
+# Unfused variant of apply_mask for masked and integer arrays
+def apply_mask_unfused(array, factor, term, invmask, missval_in, missval_out):
     new_miss_val = array.dtype.type(missval_out)
     if missval_in is not None:
         array[array == missval_in] = new_miss_val
-    if mask is not None:
-        numpy.putmask(array, numpy.broadcast_to(numpy.logical_not(mask), array.shape), new_miss_val)
+    if invmask is not None:
+        numpy.putmask(array, numpy.broadcast_to(invmask, array.shape), new_miss_val)
     if factor != 1.0 or term != 0.0:
         numpy.putmask(array, array != new_miss_val, factor * array + term)
     return array
 
 
+# Cache of surface pressure fields shared by the model level variables that are written with them. The datasets are
+# opened once and closed by close(), and the fields are read in blocks of time steps that are evicted least recently
+# used beyond the cache budget, a fraction of the memory budget.
+class ps_cache(object):
+
+    def __init__(self, fraction=0.25):
+        self.fraction = fraction
+        self.datasets = {}
+        self.variables = {}
+        self.blocks = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.RLock()
+
+    # Returns the cached variable for the dataset at path, selected by the select function, for the given key (e.g.
+    # the output frequency)
+    def get_variable(self, path, select, key=None):
+        with self.lock:
+            if (path, key) in self.variables:
+                return self.variables[(path, key)]
+            if path not in self.datasets:
+                self.datasets[path] = netCDF4.Dataset(path, 'r')
+            ncvar = select(self.datasets[path])
+            if ncvar is None:
+                return None
+            variable = cached_variable(self, (path, key), ncvar)
+            self.variables[(path, key)] = variable
+            return variable
+
+    def get_budget(self):
+        return self.fraction * get_memory_budget()
+
+    # Returns the block with the given index of the variable, reading it if necessary
+    def get_block(self, variable, index):
+        with self.lock:
+            key = variable.key + (index,)
+            if key in self.blocks:
+                block = self.blocks.pop(key)
+                self.blocks[key] = block
+                return block
+            start = index * variable.block_steps
+            block = variable.ncvar[start:min(start + variable.block_steps, variable.shape[0])]
+            block.flags.writeable = False
+            self.blocks[key] = block
+            self.nbytes += block.nbytes
+            while self.nbytes > self.get_budget() and len(self.blocks) > 1:
+                self.nbytes -= self.blocks.popitem(last=False)[1].nbytes
+            return block
+
+    # Drops the cached blocks and closes the dataset at path, or all datasets if no path is given
+    def close(self, path=None):
+        with self.lock:
+            paths = self.datasets.keys() if path is None else [path]
+            for key in [k for k in self.blocks if k[0] in paths]:
+                self.nbytes -= self.blocks.pop(key).nbytes
+            for key in [k for k in self.variables if k[0] in paths]:
+                del self.variables[key]
+            for p in [p for p in paths if p in self.datasets]:
+                self.datasets.pop(p).close()
+
+
+# Variable wrapper reading the leading (time) axis through the blocks of a ps_cache. The returned arrays are read-only
+# views of the cached blocks when possible.
+class cached_variable(object):
+
+    def __init__(self, cache, key, ncvar):
+        self.cache = cache
+        self.key = key
+        self.ncvar = ncvar
+        self.shape = ncvar.shape
+        self.dtype = ncvar.dtype
+        self.size = numpy.prod(ncvar.shape)
+        step_bytes = max(1, self.size / max(1, self.shape[0])) * numpy.dtype(self.dtype).itemsize
+        self.block_steps = max(1, int(cache.get_budget() / (4 * step_bytes)))
+
+    def __getattr__(self, name):
+        return getattr(self.ncvar, name)
+
+    def __getitem__(self, index):
+        index = index if isinstance(index, tuple) else (index,)
+        first = index[0] if len(index) > 0 else slice(None)
+        if not isinstance(first, slice) or first.step not in [None, 1] or len(self.shape) == 0:
+            return self.ncvar[index]
+        start, stop, _ = first.indices(self.shape[0])
+        if stop <= start:
+            return self.ncvar[index]
+        n = self.block_steps
+        parts = [self.cache.get_block(self, b)[max(start - b * n, 0):stop - b * n]
+                 for b in range(start // n, (stop - 1) // n + 1)]
+        if len(parts) == 1:
+            data = parts[0]
+        elif any([isinstance(p, numpy.ma.MaskedArray) for p in parts]):
+            data = numpy.ma.concatenate(parts)
+        else:
+            data = numpy.concatenate(parts)
+        return data[(slice(None),) + index[1:]]
+
+
 class ScriptUtils:
 
     def __init__(self):
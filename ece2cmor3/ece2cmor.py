@@ -41,8 +41,11 @@ def main(args=None):
                         help="EC-Earth configuration (only used with --drq option)")
     parser.add_argument("--refd", metavar="YYYY-mm-dd", type=str, default="1850-01-01",
                         help="Reference date for output time axes")
-    parser.add_argument("--npp", metavar="N", type=int, default=8, help="Number of parallel tasks (only relevant for "
-                                                                        "IFS cmorization")
+    parser.add_argument("--npp", metavar="N", type=int, default=8, help="Number of parallel post-processing tasks "
+                                                                        "(only relevant for IFS cmorization)")
+    parser.add_argument("--mem", metavar="MB", type=int, default=None, help="Memory budget in MB for writing data to "
+                                                                            "cmor (default: $ECE2CMOR3_MEMORY_MB "
+                                                                            "or 4 GB)")
     parser.add_argument("--log", action="store_true", default=False, help="Write to log file")
     parser.add_argument("--flatdir", action="store_true", default=False, help="Do not create sub-directories in "
                                                                                     "output folder")
@@ -108,6 +111,8 @@ def main(args=None):
                            create_subdirs=(not args.flatdir))
     ece2cmorlib.enable_masks = not args.nomask
     ece2cmorlib.auto_filter = not args.nofilter
+    if args.mem is not None:
+        cmor_utils.memory_budget = max(1, args.mem) * 2 ** 20
 
     active_components = cmor_utils.ScriptUtils.get_active_components(args, args.ececonf)
 
@@ -1,5 +1,6 @@
 import os
 import csv
+import mmap
 import subprocess
 
 import gribapi
@@ -20,6 +21,9 @@ param_key = "paramId"
 levtype_key = "indicatorOfTypeOfLevel"
 level_key = "level"
 
+# Columns of the message index: byte offset, byte length and the header keys used for filtering
+index_columns = ["offset", "length", date_key, time_key, param_key, levtype_key, level_key]
+
 test_mode = False
 
 
@@ -33,14 +37,56 @@ def initialize():
         os.environ["GRIB_API_PYTHON_NO_TYPE_CHECKS"] = "1"
 
 
-# Factory method
-def create_grib_file(file_object_):
+# Factory method, returns an index-driven reader if a message index is given
+def create_grib_file(file_object_, index=None):
+    if index is not None:
+        return indexed_grib_file(file_object_, index)
     if test_mode:
         return csv_grib_mock(file_object_)
     else:
         return ecmwf_grib_api(file_object_)
 
 
+# Scans the grib file once and returns the list of index records of its messages
+def create_index(path):
+    result = []
+    with open(path, 'r') as file_object:
+        gribfile = create_grib_file(file_object)
+        while gribfile.read_next(headers_only=True):
+            result.append((gribfile.get_offset(), gribfile.get_length()) +
+                          tuple([gribfile.get_field(k) for k in index_columns[2:]]))
+            gribfile.release()
+    return result
+
+
+# Returns the signature of the grib file, used to validate stored indices
+def get_index_signature(path):
+    stats = os.stat(path)
+    return "%d %d" % (stats.st_size, int(stats.st_mtime))
+
+
+# Writes the message index of the grib file at path to index_path
+def write_index(index, path, index_path):
+    with open(index_path, 'w') as ofile:
+        ofile.write("# " + get_index_signature(path) + "\n")
+        writer = csv.writer(ofile)
+        writer.writerow(index_columns)
+        writer.writerows(index)
+
+
+# Reads a message index from index_path, returns None if it does not match the grib file at path
+def read_index(path, index_path):
+    if not os.path.isfile(index_path):
+        return None
+    with open(index_path, 'r') as ifile:
+        if ifile.readline().strip() != "# " + get_index_signature(path):
+            return None
+        reader = csv.reader(ifile)
+        if next(reader, None) != index_columns:
+            return None
+        return [tuple([int(c) for c in row]) for row in reader if any(row)]
+
+
 # Interface for grib file object
 class grib_file(object):
 
@@ -59,6 +105,21 @@ class grib_file(object):
     def get_field(self, name):
         pass
 
+    def get_string(self, name):
+        pass
+
+    def get_array(self, name):
+        pass
+
+    def get_values(self):
+        pass
+
+    def get_offset(self):
+        pass
+
+    def get_length(self):
+        pass
+
     def release(self):
         pass
 
@@ -78,7 +139,7 @@ class ecmwf_grib_api(grib_file):
         return self.record is not None
 
     def write(self, file_object_):
-        gribapi.grib_write(self.record, file_object_)
+        file_object_.write(gribapi.grib_get_message(self.record))
 
     def set_field(self, name, value):
         gribapi.grib_set(self.record, name, value)
@@ -86,6 +147,21 @@ class ecmwf_grib_api(grib_file):
     def get_field(self, name):
         return gribapi.grib_get_long(self.record, name)
 
+    def get_string(self, name):
+        return gribapi.grib_get_string(self.record, name)
+
+    def get_array(self, name):
+        return gribapi.grib_get_array(self.record, name)
+
+    def get_values(self):
+        return gribapi.grib_get_values(self.record)
+
+    def get_offset(self):
+        return gribapi.grib_get_long(self.record, "offset")
+
+    def get_length(self):
+        return gribapi.grib_get_long(self.record, "totalLength")
+
     def release(self):
         gribapi.grib_release(self.record)
 
@@ -100,10 +176,13 @@ class csv_grib_mock(grib_file):
     def __init__(self, file_object_):
         super(csv_grib_mock, self).__init__(file_object_)
         self.row = []
-        self.reader = csv.reader(file_object_, delimiter=',')
+        self.offset, self.length = 0, 0
 
     def read_next(self, headers_only=False):
-        self.row = next(self.reader, None)
+        self.offset = self.file_object.tell()
+        line = self.file_object.readline()
+        self.length = len(line)
+        self.row = next(csv.reader([line], delimiter=','), None) if line else None
         return self.row is not None
 
     def write(self, file_object_):
@@ -116,8 +195,110 @@ class csv_grib_mock(grib_file):
     def get_field(self, name):
         return int(self.row[csv_grib_mock.columns.index(name)])
 
+    def get_string(self, name):
+        return None
+
+    def get_array(self, name):
+        return None
+
+    def get_values(self):
+        return None
+
+    def get_offset(self):
+        return self.offset
+
+    def get_length(self):
+        return self.length
+
     def release(self):
         self.row = []
 
     def eof(self):
         return self.row is None
+
+
+# Index-driven implementation of grib file interface: header queries are answered from the message index and
+# messages are only decoded when they are modified. Unmodified messages are copied as raw bytes from the memory-mapped
+# input file.
+class indexed_grib_file(grib_file):
+    columns = {k: i for i, k in enumerate(index_columns)}
+
+    def __init__(self, file_object_, index):
+        super(indexed_grib_file, self).__init__(file_object_)
+        self.index = index
+        self.position = -1
+        self.decoded = False
+        self.buffer = None
+        self.reader = ecmwf_grib_api(file_object_) if not test_mode else csv_grib_mock(file_object_)
+
+    def read_next(self, headers_only=False):
+        self.release()
+        self.position += 1
+        if self.position < len(self.index):
+            return True
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
+        return False
+
+    # Returns the raw bytes of the current message, or None if the indexed message boundaries are not valid
+    def get_message(self):
+        if self.buffer is None:
+            fileno = self.file_object.fileno()
+            if os.fstat(fileno).st_size == 0:
+                return None
+            self.buffer = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        offset, length = self.index[self.position][0], self.index[self.position][1]
+        if offset + length > len(self.buffer):
+            return None
+        message = self.buffer[offset:offset + length]
+        if not test_mode and (message[:4] != "GRIB" or message[-4:] != "7777"):
+            return None
+        return message
+
+    def decode(self):
+        if not self.decoded:
+            self.file_object.seek(self.index[self.position][0])
+            self.decoded = self.reader.read_next()
+        return self.decoded
+
+    def write(self, file_object_):
+        if not self.decoded:
+            message = self.get_message()
+            if message is not None:
+                file_object_.write(message)
+                return
+        if self.decode():
+            self.reader.write(file_object_)
+
+    def set_field(self, name, value):
+        if self.decode():
+            self.reader.set_field(name, value)
+
+    def get_field(self, name):
+        if self.decoded:
+            return self.reader.get_field(name)
+        return self.index[self.position][indexed_grib_file.columns[name]]
+
+    def get_string(self, name):
+        return self.reader.get_string(name) if self.decode() else None
+
+    def get_array(self, name):
+        return self.reader.get_array(name) if self.decode() else None
+
+    def get_values(self):
+        return self.reader.get_values() if self.decode() else None
+
+    def get_offset(self):
+        return self.index[self.position][0]
+
+    def get_length(self):
+        return self.index[self.position][1]
+
+    def release(self):
+        if self.decoded:
+            self.reader.release()
+            self.decoded = False
+
+    def eof(self):
+        return self.position >= len(self.index)
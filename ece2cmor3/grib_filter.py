@@ -1,10 +1,14 @@
 import datetime
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
 import re
 import resource
+import shutil
 import threading
+from collections import OrderedDict
 
 import numpy
 
@@ -17,11 +21,28 @@ gridpoint_files = {}
 spectral_files = {}
 temp_dir = None
 accum_key = "ACCUMFLD"
-accum_codes = []
+accum_codes = set()
 varsfreq = {}
 # varstasks = {}
 # varsfiles = {}
 spvar = None
+# Directory where grib message indices are stored, defaults to the temporary directory
+index_dir = None
+# Message indices of the grib files, to avoid repeated scanning
+indices = {}
+# Controls whether we use the message indices to read grib files
+use_index = True
+# Number of filter passes over the grib files when tasks are released as soon as their files are complete
+filter_passes = 4
+# Path of the manifest file storing the detected field frequencies of the experiment
+manifest_path = None
+# Maximal number of simultaneously open output files, if zero it is derived from the open file limit
+max_open_files = 0
+# Number of file descriptors kept available for other purposes than the output files
+reserved_files = 64
+# Maximal size of the write buffer of a single output file and the total write buffer size
+write_block_size = 4 * 1024 * 1024
+write_buffer_size = 512 * 1024 * 1024
 
 
 # Initializes the module, looks up previous month files and inspects the first
@@ -38,26 +59,123 @@ def update_sp_key(fname):
                 spvar = (134, freq, fname)
 
 
-def initialize(gpfiles, shfiles, tmpdir):
-    global gridpoint_files, spectral_files, temp_dir, varsfreq, accum_codes
+def initialize(gpfiles, shfiles, tmpdir, indexdir=None, manifest=None):
+    global gridpoint_files, spectral_files, temp_dir, index_dir, manifest_path, varsfreq, accum_codes
     grib_file.initialize()
     gridpoint_files = {d: (get_prev_file(gpfiles[d]), gpfiles[d]) for d in gpfiles.keys()}
     spectral_files = {d: (get_prev_file(shfiles[d]), shfiles[d]) for d in shfiles.keys()}
     temp_dir = tmpdir
+    index_dir = tmpdir if indexdir is None else indexdir
+    manifest_path = manifest
     accum_codes = load_accum_codes(
         os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources", "grib_codes.json"))
     gpdate = sorted(gridpoint_files.keys())[0] if any(gridpoint_files) else None
     shdate = sorted(spectral_files.keys())[0] if any(spectral_files) else None
     gpfile = gridpoint_files[gpdate][1] if any(gridpoint_files) else None
     shfile = spectral_files[shdate][1] if any(spectral_files) else None
+    manifest_data = read_manifest()
     if gpfile is not None:
-        with open(gpfile) as gpf:
-            varsfreq.update(inspect_day(grib_file.create_grib_file(gpf), grid=cmor_source.ifs_grid.point))
-            update_sp_key(gpfile)
+        varsfreq.update(inspect_file(gpfile, cmor_source.ifs_grid.point, manifest_data))
+        update_sp_key(gpfile)
     if shfile is not None:
-        with open(shfile) as shf:
-            varsfreq.update(inspect_day(grib_file.create_grib_file(shf), grid=cmor_source.ifs_grid.spec))
-            update_sp_key(shfile)
+        varsfreq.update(inspect_file(shfile, cmor_source.ifs_grid.spec, manifest_data))
+        update_sp_key(shfile)
+    write_manifest(manifest_data)
+
+
+# Returns the field frequencies in the grib file, taken from the manifest if the first day of the file matches the
+# stored fingerprint, otherwise by inspecting the first day. The manifest data is updated with the results.
+def inspect_file(path, grid, manifest_data):
+    grid_key = "spectral" if grid == cmor_source.ifs_grid.spec else "gridpoint"
+    fingerprint = get_fingerprint(path)
+    entry = manifest_data.get(grid_key, {})
+    if fingerprint is not None and entry.get("fingerprint", None) == fingerprint:
+        log.info("Using field frequencies from manifest %s for grib file %s" % (manifest_path, path))
+        return {tuple(item[:-1]): item[-1] for item in entry["varsfreq"]}
+    with open(path) as fin:
+        result = inspect_day(grib_file.create_grib_file(fin, get_index(path)), grid=grid)
+    if fingerprint is not None:
+        manifest_data[grid_key] = {"fingerprint": fingerprint,
+                                   "varsfreq": sorted([list(k) + [int(v)] for k, v in result.iteritems()])}
+    return result
+
+
+# Returns a fingerprint of the message headers in the first day of the grib file, computed from the message index
+def get_fingerprint(path):
+    index = get_index(path)
+    if manifest_path is None or index is None:
+        return None
+    columns = [grib_file.index_columns.index(k) for k in [grib_file.date_key, grib_file.time_key,
+                                                          grib_file.param_key, grib_file.levtype_key,
+                                                          grib_file.level_key]]
+    rows = []
+    for row in index:
+        header = [row[i] for i in columns]
+        if any(rows) and header[0] == rows[0][0] + 1 and header[1] == rows[0][1]:
+            break
+        rows.append(header)
+    md5 = hashlib.md5()
+    for header in rows:
+        md5.update(",".join([str(h) for h in header[1:]]) + "\n")
+    return md5.hexdigest()
+
+
+# Reads the field frequency manifest, returns an empty dictionary if it does not exist or cannot be read
+def read_manifest():
+    if manifest_path is None or not os.path.isfile(manifest_path):
+        return {}
+    try:
+        with open(manifest_path) as fin:
+            return json.load(fin)
+    except (IOError, ValueError) as e:
+        log.warning("Could not read field frequency manifest %s: %s" % (manifest_path, str(e)))
+        return {}
+
+
+# Stores the field frequency manifest
+def write_manifest(manifest_data):
+    if manifest_path is None or not any(manifest_data):
+        return
+    tmp_path = manifest_path + "." + str(os.getpid())
+    try:
+        if not os.path.exists(os.path.dirname(os.path.abspath(manifest_path))):
+            os.makedirs(os.path.dirname(os.path.abspath(manifest_path)))
+        with open(tmp_path, 'w') as ofile:
+            json.dump(manifest_data, ofile)
+        os.rename(tmp_path, manifest_path)
+    except (IOError, OSError) as e:
+        log.warning("Could not store field frequency manifest %s: %s" % (manifest_path, str(e)))
+
+
+# Returns the path of the stored message index for the grib file
+def get_index_path(path):
+    return os.path.join(index_dir if index_dir else os.path.dirname(path), os.path.basename(path) + ".idx")
+
+
+# Returns the message index of the grib file, reads it from the index directory or creates it by scanning the file
+# once. Indices are kept in memory, so previous month files are not rescanned in later filter passes.
+def get_index(path):
+    global indices
+    if not use_index or path is None:
+        return None
+    key = os.path.realpath(path)
+    if key in indices:
+        return indices[key]
+    index_path = get_index_path(path)
+    index = grib_file.read_index(path, index_path)
+    if index is None:
+        log.info("Creating message index for grib file %s..." % path)
+        index = grib_file.create_index(path)
+        try:
+            if not os.path.exists(os.path.dirname(index_path)):
+                os.makedirs(os.path.dirname(index_path))
+            grib_file.write_index(index, path, index_path)
+        except (IOError, OSError) as e:
+            log.warning("Could not store message index for %s in %s: %s" % (path, index_path, str(e)))
+    else:
+        log.info("Using message index %s for grib file %s" % (index_path, path))
+    indices[key] = index
+    return index
 
 
 # Function reading the file with grib-codes of accumulated fields
@@ -65,9 +183,9 @@ def load_accum_codes(path):
     global accum_key
     data = json.loads(open(path).read())
     if accum_key in data:
-        return map(grib_tuple_from_string, data[accum_key])
+        return set(map(grib_tuple_from_string, data[accum_key]))
     else:
-        return []
+        return set()
 
 
 # Utility to make grib tuple of codes from string
@@ -292,44 +410,113 @@ def cluster_files(valid_tasks, varstasks):
     return task2files, task2freqs, varsfiles
 
 
-# Main execution loop
-def execute(tasks, filter_files=True, multi_threaded=False):
+# Main execution loop. If a callback is given, the split files are filtered in several passes and the tasks are
+# handed to the callback as soon as all their files have been written. With multiple processes, the filter jobs run on
+# the given process pool, or on new pools if none is given. Callers filtering from a background thread must pass a
+# pool created before any thread was started, because forking a multithreaded process is not safe.
+def execute(tasks, filter_files=True, multi_threaded=False, nprocs=1, callback=None, priority_tasks=None, pool=None):
     valid_fx_tasks = execute_tasks([t for t in tasks if cmor_target.get_freq(t.target) == 0], filter_files,
-                                   multi_threaded=False, once=True)
+                                   multi_threaded=False, once=True, callback=callback)
     valid_other_tasks = execute_tasks([t for t in tasks if cmor_target.get_freq(t.target) != 0], filter_files,
-                                      multi_threaded=multi_threaded, once=False)
+                                      multi_threaded=multi_threaded, once=False, nprocs=nprocs, callback=callback,
+                                      priority_tasks=priority_tasks, pool=pool)
     return valid_fx_tasks + valid_other_tasks
 
 
-def execute_tasks(tasks, filter_files=True, multi_threaded=False, once=False):
+def execute_tasks(tasks, filter_files=True, multi_threaded=False, once=False, nprocs=1, callback=None,
+                  priority_tasks=None, pool=None):
     valid_tasks, varstasks = validate_tasks(tasks)
     task2files, task2freqs, keys2files = cluster_files(valid_tasks, varstasks)
-    grids = [cmor_source.ifs_grid.point, cmor_source.ifs_grid.spec]
-    if filter_files:
-        filehandles = open_files(keys2files)
-        if multi_threaded:
-            threads = []
-            for file_list, grid in zip([gridpoint_files, spectral_files], grids):
-                thread = threading.Thread(target=filter_grib_files, 
-                                          args=(file_list, keys2files, grid, filehandles, 0, 0, once))
-                threads.append(thread)
-                thread.start()
-            threads[0].join()
-            threads[1].join()
-        else:
-            for file_list, grid in zip([gridpoint_files, spectral_files], grids):
-                filter_grib_files(file_list, keys2files, grid, filehandles, month=0, year=0, once=once)
-        for handle in filehandles.values():
-            handle.close()
     for task in task2files:
         if not task.status == cmor_task.status_failed:
             setattr(task, cmor_task.filter_output_key, [os.path.join(temp_dir, p) for p in task2files[task]])
     for task in task2freqs:
         if not task.status == cmor_task.status_failed:
             setattr(task, cmor_task.output_frequency_key, task2freqs[task])
+    if callback is None or not filter_files:
+        batches = [(keys2files, valid_tasks)]
+    else:
+        npasses = 1 if once or not use_index else filter_passes
+        batches = get_filter_batches(keys2files, task2files, npasses, priority_tasks)
+    for batch_keys, batch_tasks in batches:
+        if filter_files:
+            filter_keys(batch_keys, multi_threaded, once, nprocs, pool)
+        if callback is not None:
+            callback([t for t in batch_tasks if t.status != cmor_task.status_failed])
     return valid_tasks
 
 
+# Filters the grib files into the split files of the given keys
+def filter_keys(keys2files, multi_threaded=False, once=False, nprocs=1, pool=None):
+    if not any(keys2files):
+        return
+    if nprocs > 1 and not once:
+        filter_grib_files_parallel(keys2files, nprocs, pool)
+        return
+    grids = [cmor_source.ifs_grid.point, cmor_source.ifs_grid.spec]
+    filehandles = open_files(keys2files)
+    router = grib_router(keys2files)
+    if multi_threaded:
+        threads = []
+        for file_list, grid in zip([gridpoint_files, spectral_files], grids):
+            thread = threading.Thread(target=filter_grib_files,
+                                      args=(file_list, router, grid, filehandles, 0, 0, once))
+            threads.append(thread)
+            thread.start()
+        threads[0].join()
+        threads[1].join()
+    else:
+        for file_list, grid in zip([gridpoint_files, spectral_files], grids):
+            filter_grib_files(file_list, router, grid, filehandles, month=0, year=0, once=once)
+    for handle in filehandles.values():
+        handle.close()
+
+
+# Returns the keys restricted to the given split files
+def select_files(keys2files, fnames):
+    result = {}
+    for key, fileset in keys2files.iteritems():
+        selection = set([t for t in fileset if t[0] in fnames])
+        if any(selection):
+            result[key] = selection
+    return result
+
+
+# Divides the split files into batches that can be filtered independently, such that all files of a task end up in
+# the same batch. The batch containing the priority tasks is filtered first.
+def get_filter_batches(keys2files, task2files, npasses, priority_tasks=None):
+    groups = []
+    for task, fnames in task2files.iteritems():
+        if task.status == cmor_task.status_failed:
+            continue
+        files, group_tasks = set(fnames), [task]
+        for group in [g for g in groups if g[0] & files]:
+            files.update(group[0])
+            group_tasks.extend(group[1])
+            groups.remove(group)
+        groups.append((files, group_tasks))
+    all_files = set()
+    for fileset in keys2files.values():
+        all_files.update([t[0] for t in fileset])
+    grouped_files = set()
+    for group in groups:
+        grouped_files.update(group[0])
+    if any(all_files - grouped_files):
+        groups.append((all_files - grouped_files, []))
+    priority = set(priority_tasks) if priority_tasks else set()
+    first = [g for g in groups if priority.intersection(g[1])]
+    rest = sorted([g for g in groups if not priority.intersection(g[1])], key=lambda g: -len(g[0]))
+    nbatches = max(1, npasses - (1 if any(first) else 0))
+    batches = [(set(), []) for _ in range(min(nbatches, len(rest)))]
+    for group in rest:
+        batch = min(batches, key=lambda b: len(b[0]))
+        batch[0].update(group[0])
+        batch[1].extend(group[1])
+    if any(first):
+        batches.insert(0, (set().union(*[g[0] for g in first]), [t for g in first for t in g[1]]))
+    return [(select_files(keys2files, b[0]), b[1]) for b in batches]
+
+
 # Checks tasks that are compatible with the variables listed in grib_vars and
 # returns those that are compatible.
 def validate_tasks(tasks):
@@ -380,22 +567,192 @@ def validate_tasks(tasks):
     return valid_tasks, varstasks
 
 
-def open_files(vars2files):
+def open_files(vars2files, part=None):
     files = set()
     for fileset in vars2files.values():
         files.update(set([t[0] for t in fileset]))
-    numreq = len(files)
-    softlim = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
-    if numreq > softlim + 1:
+    if part is None:
+        paths = {f: os.path.join(temp_dir, f) for f in files}
+    else:
+        paths = {f: get_part_path(f, part) for f in files}
+    return output_file_pool(paths, get_max_open_files(len(files)))
+
+
+# Returns the number of output files that can be kept open, raises the soft limit of open files if necessary
+def get_max_open_files(numreq):
+    if max_open_files > 0:
+        return max_open_files
+    softlim, hardlim = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if numreq + reserved_files > softlim:
+        newlim = numreq + reserved_files if hardlim == resource.RLIM_INFINITY else min(numreq + reserved_files,
+                                                                                        hardlim)
         try:
-            resource.setrlimit(resource.RLIMIT_NOFILE, (numreq + 1, -1))
-        except ValueError:
-            return {}
-    return {f: open(os.path.join(temp_dir, f), 'w') for f in files}
+            resource.setrlimit(resource.RLIMIT_NOFILE, (newlim, hardlim))
+            softlim = newlim
+        except (ValueError, resource.error) as e:
+            log.warning("Could not raise the open file limit to %d: %s" % (newlim, str(e)))
+    if numreq + reserved_files > softlim:
+        log.warning("Open file limit %d is too small for %d output files, recycling file handles" %
+                    (softlim, numreq))
+    return max(1, min(numreq, softlim - reserved_files))
+
+
+# File-like object writing to an output file pool
+class pooled_file(object):
+
+    def __init__(self, pool, fname):
+        self.pool = pool
+        self.name = fname
+
+    def write(self, data):
+        self.pool.write(self.name, data)
+
+    def close(self):
+        self.pool.close(self.name)
+
+
+# Pool of buffered output files, of which at most max_open are open at any time. Data is appended to a buffer per file
+# which is written in large blocks, and the least recently written files are closed when the maximal number of open
+# files has been reached. The pool behaves like a dictionary of output file names to file-like objects.
+class output_file_pool(object):
+
+    def __init__(self, paths, max_open):
+        self.paths = paths
+        self.max_open = max_open
+        self.block_size = max(64 * 1024, min(write_block_size, write_buffer_size / max(1, len(paths))))
+        self.handles = OrderedDict()
+        self.buffers = {}
+        self.buffer_sizes = {}
+        self.lock = threading.RLock()
+        for path in paths.values():
+            open(path, 'w').close()
+        self.files = {f: pooled_file(self, f) for f in paths}
+
+    def get(self, fname, default=None):
+        return self.files.get(fname, default)
+
+    def keys(self):
+        return self.files.keys()
+
+    def values(self):
+        return self.files.values()
+
+    def __contains__(self, fname):
+        return fname in self.files
+
+    def __len__(self):
+        return len(self.files)
+
+    def __delitem__(self, fname):
+        self.close(fname)
+        del self.files[fname]
+
+    def write(self, fname, data):
+        with self.lock:
+            buf = self.buffers.setdefault(fname, [])
+            buf.append(data)
+            self.buffer_sizes[fname] = self.buffer_sizes.get(fname, 0) + len(data)
+            if self.buffer_sizes[fname] >= self.block_size:
+                self.flush(fname)
+
+    def flush(self, fname):
+        with self.lock:
+            buf = self.buffers.pop(fname, None)
+            self.buffer_sizes.pop(fname, None)
+            if not buf:
+                return
+            handle = self.handles.pop(fname, None)
+            if handle is None:
+                while len(self.handles) >= self.max_open:
+                    self.handles.popitem(last=False)[1].close()
+                handle = open(self.paths[fname], 'a')
+            self.handles[fname] = handle
+            handle.write(''.join(buf))
+
+    def close(self, fname):
+        with self.lock:
+            self.flush(fname)
+            handle = self.handles.pop(fname, None)
+            if handle is not None:
+                handle.close()
+
+
+# Returns the path of the partial output file written by the filter job with the given id
+def get_part_path(fname, part):
+    return os.path.join(temp_dir, '.'.join([fname, "part", str(part)]))
+
+
+# Filters the grib files with a pool of processes. The work is sharded by grid and month and, if there are more
+# processes than months, by groups of output files. Every job processes its month without chaining to the
+# neighbouring months and writes to private partial files, which are concatenated in job order afterwards. If no pool
+# is given, temporary pools are created.
+def filter_grib_files_parallel(keys2files, nprocs, pool=None):
+    fnames = set()
+    for fileset in keys2files.values():
+        fnames.update([t[0] for t in fileset])
+    fnames = sorted(fnames)
+    shards = [(grid, date) for grid, file_list in zip([cmor_source.ifs_grid.point, cmor_source.ifs_grid.spec],
+                                                      [gridpoint_files, spectral_files])
+              for date in sorted(file_list.keys())]
+    if not any(shards) or not any(fnames):
+        return
+    ngroups = min(len(fnames), max(1, nprocs / len(shards)))
+    groups = [fnames[i::ngroups] for i in range(ngroups)]
+    jobs = []
+    for grid, date in shards:
+        for group in groups:
+            jobs.append((len(jobs), grid, date, select_files(keys2files, set(group))))
+    log.info("Filtering %d months of grib data in %d jobs with %d processes..." % (len(shards), len(jobs), nprocs))
+    if use_index:
+        grib_paths = set()
+        for file_list in [gridpoint_files, spectral_files]:
+            for prev_path, cur_path in file_list.values():
+                grib_paths.update(filter(None, [prev_path, cur_path]))
+        run_jobs(index_grib_file, sorted(grib_paths), nprocs, pool)
+    run_jobs(filter_grib_job, jobs, nprocs, pool)
+    for fname in fnames:
+        with open(os.path.join(temp_dir, fname), 'w') as ofile:
+            for job in jobs:
+                part_path = get_part_path(fname, job[0])
+                if os.path.exists(part_path):
+                    with open(part_path, 'r') as ifile:
+                        shutil.copyfileobj(ifile, ofile)
+                    os.remove(part_path)
+
+
+# Maps the worker function over the jobs on the pool, or on a temporary pool if none is given
+def run_jobs(func, jobs, nprocs, pool=None):
+    if pool is not None:
+        return pool.map(func, jobs)
+    pool = multiprocessing.Pool(processes=min(nprocs, len(jobs)))
+    try:
+        return pool.map(func, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# Creates and stores the message index of the grib file, worker function for the filter process pool
+def index_grib_file(path):
+    get_index(path)
+    return path
+
+
+# Filters a single month of grib data into partial output files, worker function for the filter process pool
+def filter_grib_job(job):
+    part, grid, date, job_keys = job
+    file_list = gridpoint_files if grid == cmor_source.ifs_grid.point else spectral_files
+    handles = open_files(job_keys, part=part)
+    try:
+        filter_grib_files({date: file_list[date]}, grib_router(job_keys), grid, handles)
+    finally:
+        for handle in handles.values():
+            handle.close()
+    return part
 
 
 # Processes month of grib data, including 0-hour fields in the previous month file.
-def filter_grib_files(file_list, keys2files, grid, handles=None, month=0, year=0, once=False):
+def filter_grib_files(file_list, router, grid, handles=None, month=0, year=0, once=False):
     dates = sorted(file_list.keys())
     for i in range(len(dates)):
         date = dates[i]
@@ -405,18 +762,20 @@ def filter_grib_files(file_list, keys2files, grid, handles=None, month=0, year=0
         prev_chained = i > 0 and (prev_grib_file == file_list[dates[i - 1]][1])
         if prev_grib_file is not None and not prev_chained:
             with open(prev_grib_file, 'r') as fin:
-                proc_initial_month(date.month, grib_file.create_grib_file(fin), keys2files, grid, handles, once)
+                proc_initial_month(date.month, grib_file.create_grib_file(fin, get_index(prev_grib_file)),
+                                   router, grid, handles, once)
         next_chained = i < len(dates) - 1 and (cur_grib_file == file_list[dates[i + 1]][0])
         with open(cur_grib_file, 'r') as fin:
             log.info("Filtering grib file %s..." % cur_grib_file)
+            gribfile = grib_file.create_grib_file(fin, get_index(cur_grib_file))
             if next_chained:
-                proc_grib_file(grib_file.create_grib_file(fin), keys2files, grid, handles, once)
+                proc_grib_file(gribfile, router, grid, handles, once)
             else:
-                proc_final_month(date.month, grib_file.create_grib_file(fin), keys2files, grid, handles, once)
+                proc_final_month(date.month, gribfile, router, grid, handles, once)
 
 
 # Function writing data from previous monthly file, writing the 0-hour fields
-def proc_initial_month(month, gribfile, keys2files, gridtype, handles, once=False):
+def proc_initial_month(month, gribfile, router, gridtype, handles, once=False):
     timestamp = -1
     keys = set()
     while gribfile.read_next() and (handles is None or any(handles.keys())):
@@ -431,12 +790,12 @@ def proc_initial_month(month, gribfile, keys2files, gridtype, handles, once=Fals
                 timestamp = t
             keys.add(key)
             if (key[0], key[1]) not in accum_codes:
-                write_record(gribfile, key, keys2files, handles=handles, once=once)
+                write_record(gribfile, key, router, handles=handles, once=once)
         gribfile.release()
 
 
 # Function writing data from previous monthly file, writing the 0-hour fields
-def proc_grib_file(gribfile, keys2files, gridtype, handles, once=False):
+def proc_grib_file(gribfile, router, gridtype, handles, once=False):
     timestamp = -1
     keys = set()
     while gribfile.read_next() and (handles is None or any(handles.keys())):
@@ -448,13 +807,13 @@ def proc_grib_file(gribfile, keys2files, gridtype, handles, once=False):
             keys = set()
             timestamp = t
         keys.add(key)
-        write_record(gribfile, key, keys2files, shift=-1 if (key[0], key[1]) in accum_codes else 0,
+        write_record(gribfile, key, router, shift=-1 if (key[0], key[1]) in accum_codes else 0,
                      handles=handles, once=once)
         gribfile.release()
 
 
 # Function writing data from previous monthly file, writing the 0-hour fields
-def proc_final_month(month, gribfile, keys2files, gridtype, handles, once=False):
+def proc_final_month(month, gribfile, router, gridtype, handles, once=False):
     timestamp = -1
     keys = set()
     while gribfile.read_next() and (handles is None or any(handles.keys())):
@@ -469,7 +828,7 @@ def proc_final_month(month, gribfile, keys2files, gridtype, handles, once=False)
                 keys = set()
                 timestamp = t
             keys.add(key)
-            write_record(gribfile, key, keys2files, shift=-1 if (key[0], key[1]) in accum_codes else 0,
+            write_record(gribfile, key, router, shift=-1 if (key[0], key[1]) in accum_codes else 0,
                          handles=handles, once=once)
         elif mon == month % 12 + 1:
             t = gribfile.get_field(grib_file.time_key)
@@ -481,29 +840,50 @@ def proc_final_month(month, gribfile, keys2files, gridtype, handles, once=False)
                 timestamp = t
             keys.add(key)
             if (key[0], key[1]) in accum_codes:
-                write_record(gribfile, key, keys2files, shift=-1, handles=handles, once=once)
+                write_record(gribfile, key, router, shift=-1, handles=handles, once=once)
         gribfile.release()
 
 
 starttimes = {}
 
 
+# Routing table from grib record keys to the output files and the frequency of the record, compiled once per filter
+# execution to avoid scanning all output keys for every grib message.
+class grib_router(object):
+
+    def __init__(self, keys2files):
+        self.level_files, self.axis_files = {}, {}
+        for key, var_infos in keys2files.iteritems():
+            self.level_files.setdefault(key[:4], set()).update(var_infos)
+            self.axis_files.setdefault(key[:3], set()).update(var_infos)
+        self.freqs = {}
+        for key in varsfreq:
+            self.freqs.setdefault(key[:-1], varsfreq[key])
+        self.routes = {}
+        for key in self.freqs:
+            self.get(key)
+
+    # Returns the output file infos and frequency for the record key
+    def get(self, key):
+        route = self.routes.get(key, None)
+        if route is None:
+            if key[2] == grib_file.hybrid_level_code:
+                var_infos = self.axis_files.get(key[:3], set())
+            else:
+                var_infos = self.level_files.get(key[:4], set())
+            route = (frozenset(var_infos), self.freqs.get(key, 0))
+            self.routes[key] = route
+        return route
+
+
 # Writes the grib messages
-def write_record(gribfile, key, keys2files, shift=0, handles=None, once=False):
+def write_record(gribfile, key, router, shift=0, handles=None, once=False):
     global starttimes
-    if key[2] == grib_file.hybrid_level_code:
-        matches = [keys2files[k] for k in keys2files if k[:3] == key[:3]]
-    else:
-        matches = [keys2files[k] for k in keys2files if k[:4] == key[:4]]
-    var_infos = set()
-    for match in matches:
-        var_infos.update(match)
+    var_infos, freq = router.get(key)
     if not any(var_infos):
         return
     timestamp = gribfile.get_field(grib_file.time_key)
     if shift:
-        matches = [k for k in varsfreq.keys() if k[:-1] == key]
-        freq = varsfreq[matches[0]] if any(matches) else 0
         shifttime = timestamp + shift * freq * 100
         if shifttime < 0 or shifttime >= 2400:
             newdate, hours = fix_date_time(gribfile.get_field(grib_file.date_key), shifttime / 100)
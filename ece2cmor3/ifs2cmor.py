@@ -1,13 +1,18 @@
 import cmor
 import glob
+import hashlib
 import logging
 import multiprocessing
+import multiprocessing.queues
 import netCDF4
 import numpy
 import os
+import threading
+import Queue
 
 from datetime import datetime, timedelta
-from ece2cmor3 import grib_filter, cdoapi, cmor_source, cmor_target, cmor_task, cmor_utils, postproc
+from ece2cmor3 import grib_filter, grib_file, cdoapi, cmor_source, cmor_target, cmor_task, cmor_utils, postproc, \
+    numpyapi
 
 timeshift = timedelta(0)
 # Apply timeshift for instance in case you want manually to add a shift for the piControl:
@@ -38,6 +43,9 @@ start_date_ = None
 # Fast storage temporary path
 temp_dir_ = None
 
+# Directory of evaluated masks, shared by subsequent legs
+mask_dir_ = None
+
 # Reference date, times will be converted to hours since refdate
 ref_date_ = None
 
@@ -47,6 +55,9 @@ auto_filter_ = True
 # Available geospatial masks, assigned by ece2cmorlib
 masks = {}
 
+# Queue on which post-processing worker processes report the jobs they start
+worker_starts_ = None
+
 
 # Controls whether we enter filtering+post-processing stage
 def do_post_process():
@@ -63,6 +74,45 @@ def cleanup_tmpdir():
     return str(os.environ.get("ECE2CMOR3_IFS_CLEANUP", "True")).lower() != "false"
 
 
+# Controls whether supported post-processing commands are evaluated in-process with numpy instead of cdo
+def use_numpy_engine():
+    return str(os.environ.get("ECE2CMOR3_IFS_NUMPY_POSTPROC", "False")).lower() == "true"
+
+
+# Size budget for post-processed cdo output that is handed to cmor as an open dataset instead of a file in the
+# temporary directory. python-cdo still writes this output to its own temporary directory.
+def get_cdf_memory_budget():
+    env_val = os.environ.get("ECE2CMOR3_IFS_CDF_MEMORY_MB", 0)
+    try:
+        return max(0, int(env_val)) * 2 ** 20
+    except ValueError:
+        log.error("Could not interpret environment variable ECE2CMOR3_IFS_CDF_MEMORY_MB with value %s as integer" %
+                  str(env_val))
+        return 0
+
+
+# Number of cores available for post-processing, the cdo threads of concurrent commands do not exceed this number
+def get_cores():
+    env_val = os.environ.get("ECE2CMOR3_IFS_CORES", multiprocessing.cpu_count())
+    try:
+        return max(1, int(env_val))
+    except ValueError:
+        log.error("Could not interpret environment variable ECE2CMOR3_IFS_CORES with value %s as integer" %
+                  str(env_val))
+        return multiprocessing.cpu_count()
+
+
+# Number of processes used for filtering the grib files, a single process filters with threads
+def get_filter_procs():
+    env_val = os.environ.get("ECE2CMOR3_IFS_FILTER_PROCS", 1)
+    try:
+        return max(1, int(env_val))
+    except ValueError:
+        log.error("Could not interpret environment variable ECE2CMOR3_IFS_FILTER_PROCS with value %s as integer" %
+                  str(env_val))
+        return 1
+
+
 # Guesses the IFS output frequency
 def get_output_freq(task):
     # If the environment variable is set, we take that as our guess
@@ -89,7 +139,7 @@ def get_output_freq(task):
 # Initializes the processing loop.
 def initialize(path, expname, tableroot, refdate, tempdir=None, autofilter=True):
     global log, exp_name_, table_root_, ifs_gridpoint_files_, ifs_spectral_files_, ifs_init_spectral_file_,\
-        ifs_init_gridpoint_file_, temp_dir_, ref_date_, start_date_, auto_filter_
+        ifs_init_gridpoint_file_, temp_dir_, ref_date_, start_date_, auto_filter_, mask_dir_
 
     exp_name_ = expname
     table_root_ = tableroot
@@ -133,8 +183,14 @@ def initialize(path, expname, tableroot, refdate, tempdir=None, autofilter=True)
     temp_dir_ = os.path.join(tmpdir_parent, dirname)
     if not os.path.exists(temp_dir_):
         os.makedirs(temp_dir_)
+    mask_dir_ = os.path.join(tmpdir_parent, '-'.join([exp_name_, "ifs", "masks"]))
     if auto_filter_:
-        grib_filter.initialize(ifs_gridpoint_files_, ifs_spectral_files_, temp_dir_)
+        # Message indices and field frequencies are stored outside the leg work directory, so they can be reused by
+        # subsequent legs
+        index_dir = os.path.join(tmpdir_parent, '-'.join([exp_name_, "ifs", "index"]))
+        manifest = os.path.join(tmpdir_parent, '-'.join([exp_name_, "ifs", "manifest.json"]))
+        grib_filter.initialize(ifs_gridpoint_files_, ifs_spectral_files_, temp_dir_, indexdir=index_dir,
+                               manifest=manifest)
     return True
 
 
@@ -175,50 +231,296 @@ def execute(tasks, nthreads=1):
         tasks_no_filter = []
 
     if auto_filter_:
-        tasks_todo = tasks_no_filter + grib_filter.execute(tasks_to_filter, filter_files=do_post_process(),
-                                                           multi_threaded=(nthreads > 1))
+        grib_tasks = tasks_to_filter
     else:
-        tasks_todo = tasks_no_filter
+        grib_tasks = None
         for task in tasks_to_filter:
             if task.source.grid_id() == cmor_source.ifs_grid.point:
                 setattr(task, cmor_task.filter_output_key, ifs_gridpoint_files_.values())
-                tasks_todo.append(task)
+                tasks_no_filter.append(task)
             elif task.source.grid_id() == cmor_source.ifs_grid.spec:
                 setattr(task, cmor_task.filter_output_key, ifs_spectral_files_.values())
-                tasks_todo.append(task)
+                tasks_no_filter.append(task)
             else:
                 log.error("Task ifs source has unknown grid for %s in table %s" % (task.target.variable,
                                                                                    task.target.table))
                 task.set_failed()
 
-    for task in tasks_todo:
-        setattr(task, cmor_task.output_frequency_key, get_output_freq(task))
-
-    # First post-process surface pressure and mask tasks
-    for task in list(set(tasks_todo).intersection(mask_tasks + surf_pressure_tasks)):
-        postproc.post_process(task, temp_dir_, do_post_process())
-    for task in list(set(tasks_todo).intersection(mask_tasks)):
-        read_mask(task.target.variable, getattr(task, cmor_task.output_path_key))
-    proctasks = list(set(tasks_todo).intersection(regular_tasks + fx_tasks))
-    if nthreads == 1:
-        for task in proctasks:
-            cmor_worker(task)
-    else:
-        pool = multiprocessing.Pool(processes=nthreads)
-        pool.map(cmor_worker, proctasks)
-        for task in proctasks:
-            setattr(task, cmor_task.output_path_key, postproc.get_output_path(task, temp_dir_))
+    postproc.numpy_engine = use_numpy_engine()
+    numpyapi.memory_budget = cmor_utils.get_memory_budget() / max(1, nthreads)
+    postproc.cdf_memory_budget = get_cdf_memory_budget()
+    tmp_consumers.clear()
+    tmp_usage.update({"current": 0, "peak": 0})
+    tasks_todo = execute_pipeline(tasks_no_filter, grib_tasks, mask_tasks, surf_pressure_tasks,
+                                  regular_tasks + fx_tasks, nthreads)
+    log.info("Peak size of the tracked temporary files in %s: %.1f MB" % (temp_dir_, tmp_usage["peak"] / 2. ** 20))
     if cleanup_tmpdir():
         clean_tmp_data(tasks_todo)
 
 
-# Worker function for parallel cmorization (not working at the present...)
+# Filters the grib files in a background thread and post-processes and cmorizes tasks as soon as their split files
+# have been written. Surface pressure and mask tasks are processed before all other tasks. With multiple threads, the
+# post-processing is done by a pool of worker processes and the main process only runs the cmorization, which keeps
+# all CMOR calls within a single process.
+def execute_pipeline(tasks_no_filter, tasks_to_filter, mask_tasks, surf_pressure_tasks, proc_tasks, nthreads=1):
+    task_queue = Queue.Queue()
+    filtered_tasks, errors = [], []
+    pool, worker_starts, jobs, workers, lost_jobs = None, None, {}, {}, []
+    filter_procs, filter_pool = get_filter_procs(), None
+    if tasks_to_filter is not None and do_post_process() and filter_procs > 1:
+        # The filter processes are forked here, before the filter thread is started
+        filter_pool = multiprocessing.Pool(processes=filter_procs)
+    if nthreads > 1:
+        worker_starts = multiprocessing.queues.SimpleQueue()
+        pool = multiprocessing.Pool(processes=nthreads, initializer=init_postproc_worker, initargs=(worker_starts,))
+
+    def filter_worker():
+        try:
+            filtered_tasks.extend(grib_filter.execute(tasks_to_filter, filter_files=do_post_process(),
+                                                      multi_threaded=(nthreads > 1), nprocs=filter_procs,
+                                                      callback=lambda tasks: task_queue.put(("filtered", tasks)),
+                                                      priority_tasks=mask_tasks + surf_pressure_tasks,
+                                                      pool=filter_pool))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            task_queue.put(("filtered", None))
+
+    def post_process_async(task):
+        jobs[id(task)] = (task, pool.apply_async(postproc_worker, (task, id(task)),
+                                                 callback=lambda result: task_queue.put(("postprocessed",
+                                                                                         (task, result)))))
+
+    def compute_intermediate_async(job):
+        jobs[id(job)] = (job, pool.apply_async(intermediate_worker,
+                                               (postproc.get_intermediate_args(job, job.threads), id(job)),
+                                               callback=lambda result: task_queue.put(("intermediate",
+                                                                                       (job, result)))))
+
+    def schedule(tasks):
+        for t in tasks:
+            if pool is None or (postproc.supports_in_memory(t) and not postproc.supports_numpy(t)):
+                local_tasks.append(t)
+            else:
+                scheduled.append(t)
+        scheduled.sort(key=postproc.estimate_cost, reverse=True)
+
+    def finish_intermediate(job, result):
+        released_tasks, released_jobs = postproc.finish_intermediate(job, result)
+        ready_jobs.extend(released_jobs)
+        schedule(released_tasks)
+
+    task_queue.put(("filtered", tasks_no_filter))
+    filter_thread = None
+    if tasks_to_filter is not None:
+        filter_thread = threading.Thread(target=filter_worker)
+        filter_thread.daemon = True
+        filter_thread.start()
+    else:
+        task_queue.put(("filtered", None))
+    waiting = set(mask_tasks + surf_pressure_tasks)
+    pending, local_tasks, scheduled, ready_jobs = [], [], [], []
+    filtering, num_jobs, num_threads = True, 0, 0
+    cores = get_cores()
+    completed = False
+    try:
+        while filtering or num_jobs > 0 or any(local_tasks) or any(scheduled) or any(ready_jobs):
+            if any(local_tasks) and task_queue.empty():
+                task = local_tasks.pop(0)
+                setattr(task, postproc.threads_key, min(postproc.get_threads(task), cores))
+                cmor_worker(task)
+                if task not in surf_pressure_tasks:
+                    numpyapi.release(getattr(task, cmor_task.output_path_key, None))
+                register_tmp_files(task, [getattr(task, cmor_task.output_path_key, None)])
+                release_tmp_files(task)
+                continue
+            try:
+                message, content = task_queue.get(timeout=1)
+            except Queue.Empty:
+                lost = get_lost_jobs(jobs, workers, worker_starts)
+                lost_jobs.extend(lost)
+                for item in lost:
+                    if isinstance(item, postproc.intermediate_job):
+                        log.error("Shared intermediate %s did not complete in the worker pool" % item.path)
+                        task_queue.put(("intermediate", (item, None)))
+                        continue
+                    log.error("Post-processing target %s in table %s did not complete in the worker pool" %
+                              (item.target.variable, item.target.table))
+                    task_queue.put(("postprocessed", (item, (cmor_task.status_failed, None, None, None))))
+                continue
+            if message == "postprocessed":
+                num_jobs -= 1
+                task, result = content
+                jobs.pop(id(task), None)
+                num_threads -= getattr(task, postproc.threads_key, 1)
+                postproc.release_intermediate(task)
+                task.status = result[0]
+                if result[1] is not None:
+                    setattr(task, cmor_task.output_path_key, result[1])
+                if result[2] is not None:
+                    setattr(task, "cdo_command", result[2])
+                if result[3] is not None:
+                    numpyapi.store(result[1], result[3])
+                if task.status != cmor_task.status_failed:
+                    register_tmp_files(task, [getattr(task, cmor_task.output_path_key, None)])
+                    cmor_writer(task)
+                numpyapi.release(getattr(task, cmor_task.output_path_key, None))
+                release_tmp_files(task)
+            elif message == "intermediate":
+                num_jobs -= 1
+                job, result = content
+                jobs.pop(id(job), None)
+                num_threads -= job.threads
+                finish_intermediate(job, result)
+            elif content is None:
+                filtering = False
+            else:
+                for task in content:
+                    setattr(task, cmor_task.output_frequency_key, get_output_freq(task))
+                for task in [t for t in content if t in proc_tasks or t in surf_pressure_tasks or t in mask_tasks]:
+                    register_tmp_files(task, get_filter_files(task))
+                stored_masks = [t for t in content if t in mask_tasks and load_mask(t)]
+                for task in [t for t in content if t in surf_pressure_tasks or t in mask_tasks]:
+                    if task not in stored_masks:
+                        postproc.post_process(task, temp_dir_, do_post_process(), in_memory=True)
+                for task in [t for t in content if t in mask_tasks and t not in stored_masks]:
+                    read_mask(task.target.variable, getattr(task, cmor_task.output_path_key),
+                              getattr(task, "mask_path", None))
+                    register_tmp_files(task, [getattr(task, cmor_task.output_path_key, None)])
+                for task in [t for t in content if t in surf_pressure_tasks]:
+                    for consumer in [t for t in proc_tasks if getattr(t, "sp_task", None) is task and
+                                     t.status != cmor_task.status_failed]:
+                        register_tmp_files(consumer, [getattr(task, cmor_task.output_path_key, None)])
+                for task in [t for t in content if t in surf_pressure_tasks or t in mask_tasks]:
+                    release_tmp_files(task)
+                waiting.difference_update(content)
+                pending.extend([t for t in content if t in proc_tasks])
+            if any(pending) and (not any(waiting) or not filtering):
+                intermediate_jobs = postproc.plan_commands(pending, temp_dir_) if do_post_process() else []
+                blocked = set([t for j in intermediate_jobs for t in j.tasks])
+                ready_jobs.extend([j for j in intermediate_jobs if j.parent is None])
+                schedule([t for t in pending if t not in blocked])
+                pending = []
+            # Shared intermediates first, the tasks reading them are released when they are done
+            while any(ready_jobs) and (pool is None or (num_jobs < nthreads and num_threads < cores)):
+                job = ready_jobs.pop(0)
+                job.threads = min(postproc.cdo_threads, cores - num_threads)
+                if pool is None:
+                    finish_intermediate(job, intermediate_worker(postproc.get_intermediate_args(job, job.threads)))
+                    continue
+                compute_intermediate_async(job)
+                num_jobs += 1
+                num_threads += job.threads
+            # Largest tasks first, with at most as many cdo threads as cores in flight
+            while any(scheduled) and num_jobs < nthreads and num_threads < cores:
+                task = scheduled.pop(0)
+                threads = min(postproc.get_threads(task), cores - num_threads)
+                setattr(task, postproc.threads_key, threads)
+                post_process_async(task)
+                num_jobs += 1
+                num_threads += threads
+        completed = True
+    finally:
+        if pool is not None:
+            # The results of lost jobs are never returned, so joining a closed pool would wait forever
+            if completed and not any(lost_jobs):
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+        if filter_thread is not None and completed:
+            filter_thread.join()
+        if filter_pool is not None:
+            if completed:
+                filter_pool.close()
+            else:
+                filter_pool.terminate()
+            filter_pool.join()
+        numpyapi.release_all()
+        sp_cache.close()
+        release_time_selections()
+    if any(errors):
+        raise errors[0]
+    return tasks_no_filter + filtered_tasks
+
+
+# Worker function for serial post-processing and cmorization
 def cmor_worker(task):
     log.info("Post-processing variable %s for target variable %s..." % (task.source.get_grib_code().var_id,
                                                                         task.target.variable))
-    postproc.post_process(task, temp_dir_, do_post_process())
+    postproc.post_process(task, temp_dir_, do_post_process(), in_memory=True)
+    postproc.release_intermediate(task)
     if task.status == cmor_task.status_failed:
         return
+    cmor_writer(task)
+
+
+# Initializer of the post-processing worker processes, the workers report the jobs they start to the queue
+def init_postproc_worker(queue):
+    global worker_starts_
+    worker_starts_ = queue
+
+
+# Returns the tasks of the post-processing jobs that will not report back: jobs that failed outside of the worker
+# function, e.g. because their result could not be sent back, and jobs whose worker process died
+def get_lost_jobs(jobs, workers, starts):
+    while starts is not None and not starts.empty():
+        key, pid = starts.get()
+        workers[key] = pid
+    for key in [k for k in workers if k not in jobs]:
+        workers.pop(key)
+    lost = []
+    for key, (task, job) in jobs.items():
+        if job.ready():
+            if not job.successful():
+                lost.append(key)
+        elif key in workers and not is_process_alive(workers[key]):
+            lost.append(key)
+    for key in lost:
+        workers.pop(key, None)
+    return [jobs.pop(key)[0] for key in lost]
+
+
+# Returns true if the process with the given id has not exited
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+# Worker function computing a shared intermediate of the post-processing, returns the intermediate file or None
+def intermediate_worker(args, key=None):
+    if worker_starts_ is not None and key is not None:
+        worker_starts_.put((key, os.getpid()))
+    try:
+        return postproc.compute_intermediate(*args)
+    except Exception as e:
+        log.error("Computing shared intermediate %s failed: %s" % (args[2], str(e)))
+        return None
+
+
+# Worker function for parallel post-processing, returns the task status, output path, cdo command and the output of
+# the numpy engine, if any, to the main process
+def postproc_worker(task, key=None):
+    if worker_starts_ is not None and key is not None:
+        worker_starts_.put((key, os.getpid()))
+    log.info("Post-processing variable %s for target variable %s..." % (task.source.get_grib_code().var_id,
+                                                                        task.target.variable))
+    try:
+        postproc.post_process(task, temp_dir_, do_post_process(), in_memory=postproc.supports_numpy(task),
+                              numpy_only=True)
+    except Exception as e:
+        log.error("Post-processing target %s in table %s failed: %s" % (task.target.variable, task.target.table,
+                                                                        str(e)))
+        task.set_failed()
+    path = getattr(task, cmor_task.output_path_key, None)
+    return task.status, path, getattr(task, "cdo_command", None), numpyapi.detach(path)
+
+
+# Cmorizes the post-processed task, must be called from the process owning the CMOR session
+def cmor_writer(task):
     log.info("Cmorizing source variable %s to target variable %s..." % (task.source.get_grib_code().var_id,
                                                                         task.target.variable))
     define_cmor_axes(task)
@@ -260,11 +562,11 @@ def get_mask_tasks(tasks):
     return result
 
 
-# Reads the post-processed mask variable and converts it into a boolean array
-def read_mask(name, filepath):
+# Reads the post-processed mask variable and converts it into a boolean array, which is stored at store_path if given
+def read_mask(name, filepath, store_path=None):
     global masks
     try:
-        dataset = netCDF4.Dataset(filepath, 'r')
+        dataset = open_dataset(filepath)
     except Exception as e:
         log.error("Could not read netcdf file %s while reading mask %s, reason: %s" % (filepath, name, e.message))
         return
@@ -290,10 +592,148 @@ def read_mask(name, filepath):
                     ncvar.shape))
             return
         f, v = masks[name]["operator"], masks[name]["rhs"]
-        func = numpy.vectorize(lambda x: f(x, v))
-        masks[name]["array"] = func(var[:, :])
+        masks[name]["array"] = numpy.asarray(f(numpy.asarray(var[:, :]), v), dtype=bool)
     finally:
         dataset.close()
+        # Only the mask array is needed, so the in-memory post-processing result can go
+        numpyapi.release(filepath)
+    if store_path is not None:
+        store_mask(masks[name]["array"], store_path)
+
+
+# Returns the path of the stored mask for the mask task. The file name contains the checksum of the grib messages of
+# the mask source field and of the mask predicate, so later legs with the same source field reuse it. Returns None if
+# the source field cannot be read.
+def get_mask_path(task):
+    global mask_dir_, masks
+    name = task.target.variable
+    paths = getattr(task, cmor_task.filter_output_key, None)
+    if mask_dir_ is None or name not in masks or not paths:
+        return None
+    paths = [paths] if isinstance(paths, basestring) else paths
+    codes = [(c.var_id, c.tab_id) for c in task.source.get_root_codes()]
+    digests = set()
+    try:
+        for path in paths:
+            with open(path, 'rb') as grib:
+                gribfile = grib_file.create_grib_file(grib, grib_file.create_index(path))
+                while gribfile.read_next():
+                    code = grib_filter.grib_tuple_from_int(gribfile.get_field(grib_file.param_key))
+                    if code in codes:
+                        digests.add(get_field_digest(gribfile, code))
+                    gribfile.release()
+    except Exception as e:
+        log.warning("Could not compute the checksum of the source field of mask %s: %s" % (name, str(e)))
+        return None
+    if not digests:
+        return None
+    checksum = hashlib.md5()
+    for digest in sorted(digests):
+        checksum.update(digest)
+    f, v = masks[name]["operator"], masks[name]["rhs"]
+    checksum.update("%s %s %s" % (name, getattr(f, "__name__", str(f)), repr(v)))
+    return os.path.join(mask_dir_, "%s-%s.npy" % (name, checksum.hexdigest()))
+
+
+# Returns the checksum of the decoded values and grid of the current grib message. Header keys like the date and time
+# are left out, so the same field in later legs gives the same checksum
+def get_field_digest(gribfile, code):
+    checksum = hashlib.md5("%d.%d %d" % (code[0], code[1], gribfile.get_field(grib_file.level_key)))
+    grid = gribfile.get_string("md5GridSection")
+    if grid is not None:
+        checksum.update(grid)
+    values = gribfile.get_values()
+    if values is not None:
+        checksum.update(numpy.ascontiguousarray(values, dtype=numpy.float64).tostring())
+    return checksum.hexdigest()
+
+
+# Loads the stored mask for the mask task, returns False if it needs to be evaluated
+def load_mask(task):
+    global masks
+    name = task.target.variable
+    path = get_mask_path(task)
+    setattr(task, "mask_path", path)
+    if path is None or not os.path.isfile(path):
+        return False
+    try:
+        masks[name]["array"] = numpy.load(path)
+    except (IOError, ValueError) as e:
+        log.warning("Could not load stored mask %s, reason: %s" % (path, str(e)))
+        return False
+    log.info("Using stored mask %s for mask %s" % (path, name))
+    return True
+
+
+# Stores the evaluated mask array at path
+def store_mask(array, path):
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp_path = path + ".tmp.%d" % os.getpid()
+        with open(tmp_path, 'wb') as ofile:
+            numpy.save(ofile, array)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        log.warning("Could not store mask in %s, reason: %s" % (path, str(e)))
+
+
+# Returns the split grib files of the task and, when the input files are not merged within the cdo command, the merged
+# file post-processing will create from them
+def get_filter_files(task):
+    paths = getattr(task, cmor_task.filter_output_key, None)
+    if not paths:
+        return []
+    paths = [paths] if isinstance(paths, basestring) else list(paths)
+    if len(paths) > 1 and not postproc.inline_merge:
+        paths.append(postproc.get_merge_path(paths))
+    return paths
+
+
+# Returns true if the path is a temporary file in the work directory, original model output is never tracked
+def is_tmp_file(path):
+    global temp_dir_, ifs_gridpoint_files_, ifs_spectral_files_
+    if not path or not isinstance(path, basestring) or temp_dir_ is None:
+        return False
+    if os.path.dirname(os.path.abspath(path)) != os.path.abspath(temp_dir_):
+        return False
+    return path not in ifs_gridpoint_files_.values() + ifs_spectral_files_.values()
+
+
+# Adds the task as consumer of the temporary files
+def register_tmp_files(task, paths):
+    global tmp_consumers, tmp_usage
+    if not cleanup_tmpdir():
+        return
+    for path in filter(is_tmp_file, paths):
+        if path not in tmp_consumers:
+            tmp_consumers[path] = [set(), os.path.getsize(path) if os.path.isfile(path) else 0]
+            tmp_usage["current"] += tmp_consumers[path][1]
+            tmp_usage["peak"] = max(tmp_usage["peak"], tmp_usage["current"])
+        tmp_consumers[path][0].add(task)
+
+
+# Removes the task from the consumers of the temporary files and deletes the files it was the last consumer of. Must be
+# called when the task has been cmorized or has failed. Surface pressure files are closed in the cache and cached time
+# selections dropped before removal.
+def release_tmp_files(task):
+    global tmp_consumers, tmp_usage
+    for path in [p for p in tmp_consumers if task in tmp_consumers[p][0]]:
+        consumers, size = tmp_consumers[path]
+        consumers.discard(task)
+        if any(consumers):
+            continue
+        del tmp_consumers[path]
+        tmp_usage["current"] -= size
+        # The surface pressure cache may still hold the file open
+        sp_cache.close(path)
+        release_time_selections(path)
+        try:
+            if os.path.isfile(path):
+                os.remove(path)
+                log.debug("Removed temporary file %s" % path)
+        except OSError as e:
+            log.warning("Could not remove temporary file %s: %s" % (path, str(e)))
 
 
 # Deletes all temporary paths and removes temp directory
@@ -408,7 +848,13 @@ global_grid_id = -1
 local_grid_ids = {}
 time_axis_ids = {}
 time_axis_bnds = {}
+time_selections = {}
 depth_axis_ids = {}
+sp_cache = cmor_utils.ps_cache()
+
+# Temporary files with their consuming tasks and size, and the current and peak size of the tracked files
+tmp_consumers = {}
+tmp_usage = {"current": 0, "peak": 0}
 
 
 def define_cmor_axes(task):
@@ -485,7 +931,7 @@ def execute_netcdf_task(task):
         axes.append(getattr(task, "t_axis_id"))
         t_bnds = time_axis_bnds.get(getattr(task, "t_axis_id"), [])
     try:
-        dataset = netCDF4.Dataset(filepath, 'r')
+        dataset = open_dataset(filepath)
     except Exception as e:
         log.error("Could not read netcdf file %s while cmorizing variable %s in table %s. Cause: %s" % (
             filepath, task.target.variable, task.target.table, e.message))
@@ -527,25 +973,20 @@ def execute_netcdf_task(task):
             index += 1
 
         time_selection = None
-        time_stamps = cmor_utils.read_time_stamps(filepath)
-        if any(time_stamps) and len(t_bnds) > 0:
-            time_slice_map = []
-            for bnd in t_bnds:
-                candidates = [t for t in time_stamps if bnd[0] <= t <= bnd[1]]
-                if any(candidates):
-                    time_slice_map.append(time_stamps.index(candidates[0]))
-                else:
-                    log.warning("For variable %s in table %s, no valid time point could be found at %s...inserting "
-                                "missing values" % (task.target.variable, task.target.table, str(bnd[0])))
-                    time_slice_map.append(-1)
-            time_selection = numpy.array(time_slice_map)
+        if len(t_bnds) > 0:
+            time_selection = get_time_selection(filepath, getattr(task, "t_axis_id"), t_bnds)
+        if time_selection is not None:
+            for i in numpy.nonzero(time_selection < 0)[0]:
+                log.warning("For variable %s in table %s, no valid time point could be found at %s...inserting "
+                            "missing values" % (task.target.variable, task.target.table, str(t_bnds[i][0])))
 
         mask = getattr(task.target, cmor_target.mask_key, None)
         mask_array = masks[mask].get("array", None) if mask in masks else None
         missval = getattr(task.target, cmor_target.missval_key, 1.e+20)
         if flip_sign:
             missval = -missval
-        cmor_utils.netcdf2cmor(var_id, ncvar, time_dim, factor, term, store_var, get_sp_var(surf_pressure_path),
+        sp_var = get_sp_var(surf_pressure_path, getattr(surf_pressure_task, cmor_task.output_frequency_key, None))
+        cmor_utils.netcdf2cmor(var_id, ncvar, time_dim, factor, term, store_var, sp_var,
                                swaplatlon=False, fliplat=True, mask=mask_array, missval=missval,
                                time_selection=time_selection, force_fx=(cmor_target.get_freq(task.target) == 0))
         cmor.close(var_id)
@@ -556,6 +997,24 @@ def execute_netcdf_task(task):
         dataset.close()
 
 
+# Returns the time slices of the time stamps in the file for the bounds of the time axis, or None if the file has no
+# time stamps. The result is cached per file and time axis until the file is released.
+def get_time_selection(filepath, t_axis_id, t_bnds):
+    global time_selections
+    key = (filepath, t_axis_id)
+    if key not in time_selections:
+        time_stamps = read_time_stamps(filepath)
+        time_selections[key] = cmor_utils.get_time_slice_map(time_stamps, t_bnds) if any(time_stamps) else None
+    return time_selections[key]
+
+
+# Removes the cached time selections of the file, or all of them if no path is given
+def release_time_selections(path=None):
+    global time_selections
+    for key in [k for k in time_selections if path is None or k[0] == path]:
+        del time_selections[key]
+
+
 # Returns the constants A,B for unit conversions of type y = A*x + B
 def get_conversion_constants(conversion, output_frequency):
     global log
@@ -748,7 +1207,7 @@ def create_soil_depth_axis(name):
 # Makes a time axis for the given table
 def create_time_axis(freq, path, name, has_bounds):
     global log, start_date_, ref_date_
-    date_times = cmor_utils.read_time_stamps(path)
+    date_times = read_time_stamps(path)
     if len(date_times) == 0:
         log.error("Empty time step list encountered at time axis creation for files %s" % str(path))
         return 0
@@ -779,30 +1238,57 @@ def create_time_axis(freq, path, name, has_bounds):
     return cmor.axis(table_entry=str(name), units=units, coord_vals=times), date_times, date_times
 
 
-# Surface pressure variable lookup utility
-def get_sp_var(ncpath):
+# Opens the post-processed data, which is either kept in memory or stored in a netcdf file
+def open_dataset(path):
+    dataset = numpyapi.get_dataset(path)
+    if dataset is not None:
+        return dataset
+    return netCDF4.Dataset(path, 'r')
+
+
+# Reads the time stamps of the post-processed data
+def read_time_stamps(path):
+    dataset = numpyapi.get_dataset(path)
+    if dataset is not None:
+        return list(dataset.time_stamps)
+    return cmor_utils.read_time_stamps(path)
+
+
+# Surface pressure variable lookup utility, the file-based variables are read through the shared surface pressure
+# cache
+def get_sp_var(ncpath, frequency=None):
     if not ncpath:
         return None
+    dataset = numpyapi.get_dataset(ncpath)
+    if dataset is not None:
+        return dataset.variables.get("var134", None)
     if not os.path.exists(ncpath):
         return None
     try:
-        ds = netCDF4.Dataset(ncpath)
-        if "var134" in ds.variables:
-            return ds.variables["var134"]
-        for v in ds.variables:
-            if getattr(v, "code", 0) == 134:
-                return v
-        return None
+        return sp_cache.get_variable(ncpath, find_sp_ncvar, frequency)
     except Exception as e:
         log.error("Could not read netcdf file %s for surface pressure, reason: %s" % (ncpath, e.message))
         return None
 
 
+# Returns the surface pressure variable in the dataset
+def find_sp_ncvar(dataset):
+    if "var134" in dataset.variables:
+        return dataset.variables["var134"]
+    for v in dataset.variables.values():
+        if getattr(v, "code", 0) == 134:
+            return v
+    return None
+
+
 # Creates the regular gaussian grids from the postprocessed file argument.
 def create_grid_from_file(filepath):
     global log
-    command = cdoapi.cdo_command()
-    grid_descr = command.get_grid_descr(filepath)
+    dataset = numpyapi.get_dataset(filepath)
+    grid_descr = None if dataset is None else dataset.grid_descr
+    if grid_descr is None:
+        source = None if dataset is None else dataset.source
+        grid_descr = cdoapi.cdo_command().get_grid_descr(filepath if source is None else source.filepath())
     gridtype = grid_descr.get("gridtype", "unknown")
     if gridtype != "gaussian":
         log.error("Cannot read other grids then regular gaussian grids, current grid type read from file %s was % s" % (
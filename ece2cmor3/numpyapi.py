@@ -0,0 +1,478 @@
+import datetime
+import functools
+import logging
+import numpy
+import os
+import threading
+
+from ece2cmor3 import cdoapi, cmor_utils, grib_file, grib_filter
+
+# Log object
+log = logging.getLogger(__name__)
+
+# Statistics operators and their numpy reductions
+reductions = {cdoapi.cdo_command.mean: numpy.mean, cdoapi.cdo_command.min: numpy.min,
+              cdoapi.cdo_command.max: numpy.max, cdoapi.cdo_command.sum: numpy.sum}
+
+# Running accumulation of the numpy reductions over time steps
+accumulations = {numpy.mean: numpy.add, numpy.min: numpy.minimum, numpy.max: numpy.maximum, numpy.sum: numpy.add}
+
+# Time grouping functions of the calendar statistics operators
+time_groupings = {cdoapi.cdo_command.day: lambda t: (t.year, t.month, t.day),
+                  cdoapi.cdo_command.month: lambda t: (t.year, t.month),
+                  cdoapi.cdo_command.year: lambda t: t.year}
+
+# Time selection operators and the time stamp attribute they select on
+time_selections = {cdoapi.cdo_command.select + cdoapi.cdo_command.hour: "hour",
+                   cdoapi.cdo_command.select + cdoapi.cdo_command.day: "day",
+                   cdoapi.cdo_command.select + cdoapi.cdo_command.month: "month"}
+
+# Operators that select messages, these are evaluated on the grib headers before decoding the field values
+selection_operators = [cdoapi.cdo_command.select_code_operator,
+                       cdoapi.cdo_command.select_step_operator] + time_selections.keys()
+
+# Time statistics over consecutive time steps
+timsel_operators = {cdoapi.cdo_command.timselmean_operator: cdoapi.cdo_command.mean,
+                    cdoapi.cdo_command.timselmin_operator: cdoapi.cdo_command.min,
+                    cdoapi.cdo_command.timselmax_operator: cdoapi.cdo_command.max}
+
+# Calendar time statistics
+time_operators = {t + op: (t, op) for t in time_groupings for op in reductions}
+
+# Zonal statistics
+zonal_operators = {cdoapi.cdo_command.zonal + op: op for op in reductions}
+
+# All operators that can be evaluated in-process
+supported_operators = set(selection_operators + timsel_operators.keys() + time_operators.keys() +
+                          zonal_operators.keys() + [cdoapi.cdo_command.gridtype_operator,
+                                                    cdoapi.cdo_command.set_code_operator])
+
+# In-memory post-processing results, keyed by the path of the netcdf file cdo would have produced
+datasets = {}
+datasets_lock = threading.Lock()
+
+# Cached interpolation weights from reduced to regular gaussian grids
+interpolations = {}
+
+# Memory budget in bytes for the output of a single command, defaults to the cmor_utils memory budget
+memory_budget = None
+
+
+# Variable in an in-memory dataset, exposes the subset of the netCDF4 variable interface used for cmorization
+class memory_variable(object):
+
+    def __init__(self, data, dimensions, **attributes):
+        self.data = data
+        self.dimensions = dimensions
+        for key, value in attributes.iteritems():
+            setattr(self, key, value)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def size(self):
+        return self.data.size
+
+    @property
+    def ndim(self):
+        return self.data.ndim
+
+    def __getitem__(self, item):
+        return self.data[item]
+
+
+# In-memory replacement of a post-processed netcdf file: variables, time stamps and grid description. If the
+# variables are read from a netcdf dataset produced by cdo, they stay on disk in the python-cdo temporary file, which
+# is closed and removed on release.
+class memory_dataset(object):
+
+    def __init__(self, variables, time_stamps, grid_descr, source=None):
+        self.variables = variables
+        self.time_stamps = time_stamps
+        self.grid_descr = grid_descr
+        self.source = source
+
+    def set_auto_mask(self, flag):
+        pass
+
+    def close(self):
+        pass
+
+    def release(self):
+        if self.source is None:
+            return
+        filepath = self.source.filepath()
+        self.source.close()
+        self.source = None
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+
+# Series of fields of a single variable on a common grid. The fields are evaluated lazily: each field is a numpy
+# array, a grib message that is decoded on evaluation, or an operator node ("map", function, field) or
+# ("reduce", reduction, fields) over other fields.
+class field_series(object):
+
+    def __init__(self):
+        self.code = 0
+        self.grid = None
+        self.units = None
+        self.times = []
+        self.fields = []
+
+
+# Location and shape of the values of a grib message
+class grib_message(object):
+
+    def __init__(self, path, offset, shape):
+        self.path = path
+        self.offset = offset
+        self.shape = shape
+
+
+# Decodes grib messages, keeps the input files open until closed
+class message_reader(object):
+
+    def __init__(self):
+        self.files = {}
+
+    def read(self, message):
+        file_object = self.files.get(message.path, None)
+        if file_object is None:
+            file_object = open(message.path, 'rb')
+            self.files[message.path] = file_object
+        file_object.seek(message.offset)
+        gribfile = grib_file.create_grib_file(file_object)
+        if not gribfile.read_next():
+            raise ValueError("grib message at offset %d in %s cannot be read" % (message.offset, message.path))
+        try:
+            values = gribfile.get_values()
+        finally:
+            gribfile.release()
+        if values is None or values.size != numpy.prod(message.shape):
+            raise ValueError("grib message values cannot be decoded")
+        return values.reshape(message.shape).astype(numpy.float32)
+
+    def close(self):
+        for file_object in self.files.values():
+            file_object.close()
+        self.files = {}
+
+
+# Returns true if all operators of the cdo command can be evaluated in-process
+def supports(command):
+    for key in command.get_operator_keys():
+        if key not in supported_operators:
+            return False
+        if key == cdoapi.cdo_command.gridtype_operator and \
+                command.operators[key] != [cdoapi.cdo_command.regular_grid_type]:
+            return False
+    return True
+
+
+# Evaluates the cdo command on the grib input files in-process and stores the result under output_path. Returns the
+# output path, or None if the command or the input data are not supported, in which case cdo should be used.
+def apply(command, input_files, output_path):
+    global log
+    if not supports(command):
+        return None
+    operators = [(key, command.operators[key]) for key in reversed(command.get_operator_keys())]
+    nselect = 0
+    while nselect < len(operators) and operators[nselect][0] in selection_operators:
+        nselect += 1
+    try:
+        series = read_series(input_files, operators[:nselect])
+        for key, args in operators[nselect:]:
+            apply_operator(series, key, args)
+        dataset = create_dataset(series)
+    except Exception as e:
+        log.info("Falling back to cdo for %s: %s" % (output_path, str(e)))
+        return None
+    return store(output_path, dataset)
+
+
+# Stores the in-memory dataset under path
+def store(path, dataset):
+    with datasets_lock:
+        datasets[path] = dataset
+    return path
+
+
+# Stores the netcdf dataset returned by cdo under path. Nothing is loaded into memory here: the variables are read
+# lazily from the python-cdo temporary file during cmorization, the grid description is read with cdo from that file.
+def store_netcdf(path, cdf):
+    variables = {}
+    for name, variable in cdf.variables.iteritems():
+        variable.set_auto_mask(False)
+        variables[name] = variable
+    time_stamps = []
+    if "time" in variables:
+        time_stamps = cmor_utils.read_netcdf_time_stamps(variables["time"])
+    return store(path, memory_dataset(variables, time_stamps, None, source=cdf))
+
+
+# Returns the in-memory dataset stored under path, or None
+def get_dataset(path):
+    with datasets_lock:
+        return datasets.get(path, None)
+
+
+# Removes the in-memory dataset stored under path without releasing it and returns it, e.g. to send it to another
+# process
+def detach(path):
+    with datasets_lock:
+        return datasets.pop(path, None)
+
+
+# Releases the in-memory dataset stored under path
+def release(path):
+    with datasets_lock:
+        dataset = datasets.pop(path, None)
+    if dataset is not None:
+        dataset.release()
+
+
+# Releases all in-memory datasets
+def release_all():
+    with datasets_lock:
+        released = datasets.values()
+        datasets.clear()
+    for dataset in released:
+        dataset.release()
+
+
+# Scans the message headers of a single variable in the grib files, applying the selection operators. The field
+# values are only decoded when the series is evaluated.
+def read_series(input_files, operators):
+    series = field_series()
+    predicates = [make_predicate(key, args) for key, args in operators]
+    steps = []
+    for path in input_files:
+        with open(path, 'rb') as file_object:
+            gribfile = grib_file.create_grib_file(file_object)
+            while gribfile.read_next(headers_only=True):
+                try:
+                    code = grib_filter.grib_tuple_from_int(gribfile.get_field(grib_file.param_key))[0]
+                    time = read_time(gribfile)
+                    if all(predicate(code, time) for predicate in predicates):
+                        grid, shape = read_grid(gribfile)
+                        if series.grid is None:
+                            series.grid = grid
+                            series.units = gribfile.get_string("units")
+                        elif series.grid != grid:
+                            raise ValueError("grid changes within the input")
+                        if series.code == 0:
+                            series.code = code
+                        elif series.code != code:
+                            raise ValueError("multiple variables in the input")
+                        steps.append((time, gribfile.get_field(grib_file.levtype_key),
+                                      gribfile.get_field(grib_file.level_key),
+                                      grib_message(path, gribfile.get_offset(), shape)))
+                finally:
+                    gribfile.release()
+    if not any(steps):
+        raise ValueError("no matching grib messages found")
+    if len(set([(s[1], s[2]) for s in steps])) > 1:
+        raise ValueError("multiple levels in the input")
+    steps.sort(key=lambda s: s[0])
+    series.times = [s[0] for s in steps]
+    series.fields = [s[3] for s in steps]
+    if len(set(series.times)) != len(series.times):
+        raise ValueError("duplicate time stamps in the input")
+    return series
+
+
+# Creates a message filter for the selection operator
+def make_predicate(key, args):
+    if key == cdoapi.cdo_command.select_code_operator:
+        return lambda code, time: code in args
+    if key in time_selections:
+        attribute = time_selections[key]
+        return lambda code, time: getattr(time, attribute) in args
+    steps = {}
+
+    # Time steps are numbered by their distinct validity times, all messages of a time step share its number
+    def select_step(code, time):
+        if time not in steps:
+            steps[time] = len(steps) + 1
+        return steps[time] in args
+
+    return select_step
+
+
+# Reads the validity time of the current grib message
+def read_time(gribfile):
+    date, time = gribfile.get_field("validityDate"), gribfile.get_field("validityTime")
+    return datetime.datetime(date / 10000, (date % 10000) / 100, date % 100, time / 100, time % 100)
+
+
+# Reads the grid and the shape of the field values from the headers of the current grib message. Only global
+# gaussian grids without missing values are supported.
+def read_grid(gribfile):
+    grid_type = gribfile.get_string("gridType")
+    if grid_type not in ["regular_gg", "reduced_gg"]:
+        raise ValueError("unsupported grid type %s" % grid_type)
+    if gribfile.get_field("bitmapPresent") != 0:
+        raise ValueError("fields with missing values are not supported")
+    if gribfile.get_field("jScansPositively") != 0 or gribfile.get_field("longitudeOfFirstGridPoint") != 0:
+        raise ValueError("unsupported grid scanning")
+    n = gribfile.get_field("N")
+    if grid_type == "reduced_gg":
+        pl = tuple(gribfile.get_array("pl"))
+        if len(pl) != 2 * n:
+            raise ValueError("reduced gaussian grid is not global")
+        return ("reduced", n, pl), (sum(pl),)
+    ni, nj = gribfile.get_field("Ni"), gribfile.get_field("Nj")
+    if nj != 2 * n:
+        raise ValueError("regular gaussian grid is not global")
+    return ("regular", n, ni), (nj, ni)
+
+
+# Applies the operator to the series of fields
+def apply_operator(series, key, args):
+    if key in selection_operators:
+        predicate = make_predicate(key, args)
+        selection = [i for i, t in enumerate(series.times) if predicate(series.code, t)]
+        series.times = [series.times[i] for i in selection]
+        series.fields = [series.fields[i] for i in selection]
+        if not any(series.times):
+            raise ValueError("no time steps left after operator %s" % key)
+    elif key == cdoapi.cdo_command.set_code_operator:
+        series.code = int(args[0])
+    elif key == cdoapi.cdo_command.gridtype_operator:
+        if series.grid[0] == "reduced":
+            n, pl = series.grid[1], series.grid[2]
+            if max(pl) != 4 * n:
+                raise ValueError("reduced gaussian grid is not a classic reduced grid")
+            interpolation = functools.partial(interpolate_reduced, interpolation=get_interpolation(pl, 4 * n))
+            series.fields = [("map", interpolation, f) for f in series.fields]
+            series.grid = ("regular", n, 4 * n)
+    elif key in zonal_operators:
+        if series.grid[0] != "regular":
+            raise ValueError("zonal statistics require a regular grid")
+        reduction = functools.partial(reduce_zonal, reduction=reductions[zonal_operators[key]])
+        series.fields = [("map", reduction, f) for f in series.fields]
+        series.grid = ("zonal", series.grid[1], 1)
+    elif key in timsel_operators:
+        nsteps = int(args[0])
+        groups = [range(i, min(i + nsteps, len(series.times))) for i in range(0, len(series.times), nsteps)]
+        reduce_time_groups(series, groups, reductions[timsel_operators[key]])
+    elif key in time_operators:
+        grouping, operator = time_operators[key]
+        reduce_time_groups(series, group_time_steps(series.times, time_groupings[grouping]), reductions[operator])
+    else:
+        raise ValueError("unsupported operator %s" % key)
+
+
+# Groups consecutive time steps with equal key
+def group_time_steps(times, key):
+    groups, prev_key = [], None
+    for i, t in enumerate(times):
+        k = key(t)
+        if not any(groups) or k != prev_key:
+            groups.append([])
+        groups[-1].append(i)
+        prev_key = k
+    return groups
+
+
+# Replaces the fields by the reduction over each time group, time stamped at the middle of the group
+def reduce_time_groups(series, groups, reduction):
+    times, fields = [], []
+    for group in groups:
+        first, last = series.times[group[0]], series.times[group[-1]]
+        times.append(first + (last - first) / 2)
+        fields.append(("reduce", reduction, [series.fields[i] for i in group]))
+    series.times, series.fields = times, fields
+
+
+# Reduces the field along the longitudes
+def reduce_zonal(values, reduction):
+    return reduction(values.astype(numpy.float64), axis=-1, keepdims=True).astype(numpy.float32)
+
+
+# Evaluates the field of a series. Time reductions are accumulated one time step at a time, so at most a single
+# decoded input field per nested reduction is held in memory.
+def evaluate(field, reader=None):
+    if isinstance(field, numpy.ndarray):
+        return field
+    if isinstance(field, grib_message):
+        if reader is None:
+            reader = message_reader()
+            try:
+                return reader.read(field)
+            finally:
+                reader.close()
+        return reader.read(field)
+    if field[0] == "map":
+        return field[1](evaluate(field[2], reader))
+    reduction, result = field[1], None
+    for child in field[2]:
+        values = evaluate(child, reader)
+        if result is None:
+            result = values.astype(numpy.float64)
+        else:
+            accumulations[reduction](result, values, out=result)
+    if reduction is numpy.mean:
+        result /= len(field[2])
+    return result.astype(numpy.float32)
+
+
+# Returns the memory budget for the output of a single command
+def get_memory_budget():
+    return memory_budget if memory_budget is not None else cmor_utils.get_memory_budget()
+
+
+# Returns the source indices and weights for linear interpolation along the latitude rows of a reduced gaussian grid
+def get_interpolation(pl, nlon):
+    key = (pl, nlon)
+    if key not in interpolations:
+        counts = numpy.array(pl, dtype=numpy.int64)[:, numpy.newaxis]
+        offsets = numpy.concatenate(([0], numpy.cumsum(counts[:, 0])[:-1]))[:, numpy.newaxis]
+        positions = counts * numpy.arange(nlon, dtype=numpy.float64)[numpy.newaxis, :] / nlon
+        i0 = numpy.floor(positions).astype(numpy.int64)
+        weights = positions - i0
+        i1 = (i0 + 1) % counts
+        interpolations[key] = (offsets + i0 % counts, offsets + i1, weights)
+    return interpolations[key]
+
+
+# Interpolates a reduced gaussian grid field to the regular gaussian grid
+def interpolate_reduced(values, interpolation):
+    i0, i1, weights = interpolation
+    return ((1. - weights) * values[i0] + weights * values[i1]).astype(numpy.float32)
+
+
+# Returns the gaussian latitudes from north to south
+def get_gaussian_latitudes(n):
+    roots = numpy.polynomial.legendre.leggauss(2 * n)[0]
+    return numpy.degrees(numpy.arcsin(roots))[::-1]
+
+
+# Creates the in-memory dataset corresponding to the netcdf output of cdo
+def create_dataset(series):
+    if series.grid[0] == "reduced":
+        raise ValueError("output on reduced gaussian grid is not supported")
+    nlon = series.grid[2]
+    yvals = get_gaussian_latitudes(series.grid[1])
+    xvals = numpy.array([0.]) if series.grid[0] == "zonal" else numpy.arange(nlon) * 360. / nlon
+    grid_descr = {"gridtype": "gaussian", "gridsize": len(xvals) * len(yvals), "xsize": len(xvals),
+                  "ysize": len(yvals), "np": series.grid[1], "xvals": xvals, "yvals": yvals}
+    shape = (len(series.fields), len(yvals), len(xvals))
+    nbytes = numpy.prod(shape) * numpy.dtype(numpy.float32).itemsize
+    if nbytes > get_memory_budget():
+        raise ValueError("output of %.1f MB exceeds the memory budget" % (nbytes / 2. ** 20))
+    data = numpy.empty(shape, dtype=numpy.float32)
+    reader = message_reader()
+    try:
+        for i, field in enumerate(series.fields):
+            data[i, ...] = evaluate(field, reader)
+    finally:
+        reader.close()
+    attributes = {"code": series.code}
+    if series.units:
+        attributes["units"] = series.units
+    variable = memory_variable(data, ("time", "lat", "lon"), **attributes)
+    return memory_dataset({"var" + str(series.code): variable}, series.times, grid_descr)
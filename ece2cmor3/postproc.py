@@ -1,3 +1,4 @@
+import hashlib
 import logging
 import threading
 import re
@@ -8,6 +9,7 @@ from ece2cmor3 import cmor_task
 
 import grib_file
 import cdoapi
+import numpyapi
 import cmor_source
 import cmor_target
 
@@ -26,14 +28,69 @@ modes = [skip, append, recreate]
 # Mode for post-processing
 mode = 3
 
+# Controls whether the common leading operators of the cdo commands of tasks are computed once and shared
+share_intermediates = True
 
-# Post-processes a task
-def post_process(task, path, do_postprocess):
-    command = create_command(task)
+# Task attributes holding the planned cdo command and the shared intermediate input file
+command_key = "cdo_operators"
+intermediate_key = "cdo_intermediate"
+
+# Operators that are not shared, because they rename or recode variables
+unshared_operators = [cdoapi.cdo_command.expression_operator, cdoapi.cdo_command.add_expression_operator,
+                      cdoapi.cdo_command.post_expr_operator, cdoapi.cdo_command.post_addexpr_operator,
+                      cdoapi.cdo_command.set_code_operator]
+
+# Selection operators, which are cheaper to recompute than to store as shared intermediate
+selection_operators = [cdoapi.cdo_command.select_code_operator, cdoapi.cdo_command.select_z_operator,
+                       cdoapi.cdo_command.select_lev_operator, cdoapi.cdo_command.select_step_operator,
+                       cdoapi.cdo_command.select + cdoapi.cdo_command.hour,
+                       cdoapi.cdo_command.select + cdoapi.cdo_command.day,
+                       cdoapi.cdo_command.select + cdoapi.cdo_command.month, cdoapi.cdo_command.shift_time_operator]
+
+# Controls whether multiple input files are merged within the cdo command instead of into a file on disk
+inline_merge = True
+
+# Controls whether monthly and yearly statistics are derived from daily statistics that are shared with other tasks
+cascade_time_operators = True
+
+# Daily statistics operators from which the monthly and yearly statistics can be computed exactly. Means are not
+# included: a mean of daily means only equals the mean over all time steps if every day has the same number of steps,
+# which does not hold for the first day of the first leg.
+daily_operators = {cdoapi.cdo_command.month + op: cdoapi.cdo_command.day + op for op in
+                   [cdoapi.cdo_command.min, cdoapi.cdo_command.max, cdoapi.cdo_command.sum]}
+daily_operators.update({cdoapi.cdo_command.year + op: cdoapi.cdo_command.day + op for op in
+                        [cdoapi.cdo_command.min, cdoapi.cdo_command.max, cdoapi.cdo_command.sum]})
+
+# Task attribute holding the number of cdo threads assigned by the scheduler
+threads_key = "cdo_threads"
+
+# Relative costs of expensive operators, used to estimate the cost of cdo commands
+operator_costs = {cdoapi.cdo_command.spectral_operator: 8., cdoapi.cdo_command.ml2pl_operator: 4.,
+                  cdoapi.cdo_command.ml2hl_operator: 4., cdoapi.cdo_command.gridtype_operator: 2.,
+                  cdoapi.cdo_command.area_operator: 2.}
+
+# Controls whether supported commands are evaluated in-process with numpy when the output can be kept in memory
+numpy_engine = False
+
+# Size budget in bytes for tasks whose cdo output is handed to cmor as an open dataset instead of a file in the
+# temporary directory, zero disables this. The output is still a netcdf file, written to the python-cdo temporary
+# directory, but it is only read lazily during cmorization.
+cdf_memory_budget = 0
+
+# Reference counts of the shared intermediate files
+intermediates = {}
+intermediates_lock = threading.Lock()
+
+
+# Post-processes a task. If in_memory is set, the caller can use post-processed data that is registered in numpyapi
+# instead of being written to the output path: arrays computed by the numpy engine or a netcdf dataset opened from the
+# python-cdo temporary directory. With numpy_only, only the output of the numpy engine is registered.
+def post_process(task, path, do_postprocess, in_memory=False, numpy_only=False):
+    command = get_command(task)
     output_path = get_output_path(task, path)
     if do_postprocess:
         if task.status != cmor_task.status_failed:
-            filepath = apply_command(command, task, output_path)
+            filepath = apply_command(command, task, output_path, in_memory, numpy_only)
         else:
             filepath = None
     else:
@@ -46,6 +103,280 @@ def get_output_path(task, tmp_path):
     return os.path.join(tmp_path, task.target.variable + "_" + task.target.table + ".nc") if tmp_path else None
 
 
+# Returns the cdo command for the task, reconstructed from the planned operators if available
+def get_command(task):
+    planned = getattr(task, command_key, None)
+    if planned is None:
+        return create_command(task)
+    result = cdoapi.cdo_command()
+    result.operators = {k: list(v) for k, v in planned[0].iteritems()}
+    result.order = list(planned[1])
+    return result
+
+
+# Returns true if the planned command of the task can be evaluated in-process or its output fits in the size budget
+def supports_in_memory(task):
+    if getattr(task, command_key, None) is None:
+        return False
+    return supports_numpy(task) or fits_memory_budget(get_command(task), get_input_files(task))
+
+
+# Returns true if the planned command of the task can be evaluated by the numpy engine, which only reads grib input
+def supports_numpy(task):
+    if not numpy_engine or getattr(task, command_key, None) is None or hasattr(task, intermediate_key):
+        return False
+    return numpyapi.supports(get_command(task))
+
+
+# Returns true if the cdo output for the input files is expected to fit in the size budget. The netcdf output is
+# estimated from the grib input, which is usually packed with 16 bits per value.
+def fits_memory_budget(command, input_files):
+    if cdf_memory_budget <= 0 or not any(input_files):
+        return False
+    if cdoapi.cdo_command.set_code_operator in command.operators:
+        return False
+    size = sum([os.path.getsize(f) for f in input_files if os.path.exists(f)])
+    return 0 < 2 * size <= cdf_memory_budget
+
+
+# Estimates the cost of post-processing the task from the size of its input and the operators applied to it
+def estimate_cost(task):
+    size = sum([os.path.getsize(f) for f in get_input_files(task) if os.path.exists(f)])
+    if getattr(task, command_key, None) is None:
+        return float(size)
+    weights = [operator_costs.get(k, 0. if k in selection_operators else .5) for k in get_command(task).operators]
+    return size * (1. + sum(weights))
+
+
+# Returns the number of cdo threads that are useful for the task. Cdo parallelizes over the records of a time step,
+# so only commands on multiple levels benefit from more threads.
+def get_threads(task):
+    if getattr(task, command_key, None) is None or task.source.spatial_dims < 3:
+        return 1
+    command = get_command(task)
+    if all([k in selection_operators for k in command.operators]):
+        return 1
+    levels = command.operators.get(cdoapi.cdo_command.select_lev_operator, [])
+    return max(1, min(cdo_threads, len(levels) if any(levels) else cdo_threads))
+
+
+# Returns the grib input files of the task
+def get_input_files(task):
+    intermediate = getattr(task, intermediate_key, None)
+    if intermediate is not None:
+        return [intermediate[0]]
+    input_files = getattr(task, cmor_task.filter_output_key, [])
+    return [input_files] if isinstance(input_files, str) else input_files
+
+
+# Plans the cdo commands of the tasks together. Leading operator chains that are applied to the same input by
+# several tasks are computed once into a netcdf file in the temporary directory, which is used as input for the
+# remaining operators of these tasks. Returns the jobs computing these shared intermediates, ordered such that every
+# job comes after the job producing its input. Tasks reading an intermediate are listed in the tasks of its job and
+# must not be post-processed before that job has finished, see finish_intermediate. The intermediate files are
+# reference counted and removed by release_intermediate.
+def plan_commands(tasks, path):
+    global log
+    if not share_intermediates or mode == skip:
+        return []
+    commands, chains = {}, {}
+    for task in tasks:
+        if task.status == cmor_task.status_failed or hasattr(task, command_key):
+            continue
+        if mode == append and os.path.exists(get_output_path(task, path)):
+            continue
+        command = create_command(task)
+        if task.status == cmor_task.status_failed:
+            continue
+        commands[task] = command
+        input_files = getattr(task, cmor_task.filter_output_key, [])
+        if isinstance(input_files, str):
+            input_files = [input_files]
+        if any(input_files):
+            chains[task] = (tuple(input_files), get_shared_chain(command))
+    if cascade_time_operators:
+        add_cascade_operators(commands, chains)
+    for task, command in commands.iteritems():
+        setattr(task, command_key, (command.operators, command.get_operator_keys()))
+    return create_intermediate_jobs(chains, path)
+
+
+# Job computing a shared intermediate: the node is the input files and operator chain it represents, the operators
+# are applied to the output of the parent job or, without parent, to the input files
+class intermediate_job(object):
+
+    def __init__(self, node, path, operators, parent=None):
+        self.node = node
+        self.path = path
+        self.operators = operators
+        self.parent = parent
+        self.children = []
+        self.tasks = []
+        self.threads = 1
+
+
+# Returns the nodes of the operator chains that are worth sharing: prefixes used by several chains that either branch
+# into different operators afterwards or are complete chains themselves, and that do more than selecting messages
+def get_shared_nodes(chains):
+    counts, successors, ends = {}, {}, set()
+    for root, chain in chains:
+        for i in range(1, len(chain) + 1):
+            node = (root, chain[:i])
+            counts[node] = counts.get(node, 0) + 1
+            if i < len(chain):
+                successors.setdefault(node, set()).add(chain[i])
+        ends.add((root, chain))
+    return [n for n, c in counts.iteritems() if c > 1 and (len(successors.get(n, [])) > 1 or n in ends) and
+            any([key not in selection_operators for key, args in n[1]])]
+
+
+# Creates the jobs for the shared nodes of the operator chains of the tasks and assigns every task the deepest
+# intermediate of its chain. The reference count of an intermediate is the number of tasks and jobs reading it.
+def create_intermediate_jobs(chains, path):
+    jobs = {}
+    for node in sorted(get_shared_nodes(chains.values()), key=lambda n: len(n[1])):
+        root, chain = node
+        base = get_shared_input(jobs, root, chain[:-1])
+        parent = jobs[base] if base is not None else None
+        operators = chain[len(base[1]):] if base is not None else chain
+        root_name = '_'.join([os.path.basename(f) for f in root])
+        output_file = os.path.join(path, '.'.join([root_name, hashlib.md5(repr(node)).hexdigest()[:12], "nc"]))
+        jobs[node] = intermediate_job(node, output_file, operators, parent)
+        if parent is not None:
+            parent.children.append(jobs[node])
+    for task, (root, chain) in chains.iteritems():
+        node = get_shared_input(jobs, root, chain)
+        if node is not None:
+            setattr(task, intermediate_key, (jobs[node].path, len(node[1])))
+            jobs[node].tasks.append(task)
+    with intermediates_lock:
+        for job in jobs.values():
+            intermediates[job.path] = len(job.tasks) + len(job.children)
+    return sorted(jobs.values(), key=lambda j: len(j.node[1]))
+
+
+# Returns the arguments of compute_intermediate for the job
+def get_intermediate_args(job, threads=None):
+    input_files = [job.parent.path] if job.parent is not None else list(job.node[0])
+    return job.operators, input_files, job.path, cdo_threads if threads is None else threads
+
+
+# Computes a shared intermediate with cdo. The result is stored as single precision netcdf, so that the values are not
+# quantized again as they would be in grib. Returns the output file, or None if cdo failed.
+def compute_intermediate(operators, input_files, output_file, threads):
+    global log
+    command = cdoapi.cdo_command()
+    for key, args in operators:
+        command.add_operator(key, *args)
+    command.order = [key for key, args in reversed(operators)]
+    if len(input_files) > 1 and inline_merge:
+        input_file = cdoapi.cdo_command.merge_input(input_files)
+    elif len(input_files) > 1:
+        input_file = get_merge_path(input_files)
+        command.merge(input_files, input_file)
+    else:
+        input_file = input_files[0]
+    log.info("Computing shared intermediate %s from file %s with cdo command %s" %
+             (output_file, input_file, command.create_command()))
+    if command.apply(input_file, output_file, threads, precision="F32") is None:
+        return None
+    return output_file
+
+
+# Processes the result of an intermediate job and returns the tasks and child jobs that can be started now. If the
+# job failed, its tasks and child jobs fall back to the input of the job itself.
+def finish_intermediate(job, result):
+    global log
+    parent = job.parent
+    if result is None:
+        log.warning("Failed to compute shared intermediate %s, continuing without it" % job.path)
+        with intermediates_lock:
+            intermediates.pop(job.path, None)
+            if parent is not None:
+                intermediates[parent.path] = intermediates.get(parent.path, 0) + len(job.tasks) + len(job.children)
+        for task in job.tasks:
+            if parent is not None:
+                setattr(task, intermediate_key, (parent.path, len(parent.node[1])))
+            elif hasattr(task, intermediate_key):
+                delattr(task, intermediate_key)
+        for child in job.children:
+            child.operators = job.operators + child.operators
+            child.parent = parent
+        if os.path.exists(job.path):
+            os.remove(job.path)
+    if parent is not None:
+        release_file(parent.path)
+    return job.tasks, job.children
+
+
+# Returns the leading operators of the command that can be shared, in order of execution
+def get_shared_chain(command):
+    chain = []
+    for key in reversed(command.get_operator_keys()):
+        if key in unshared_operators:
+            break
+        chain.append((key, tuple(command.operators[key])))
+    return tuple(chain)
+
+
+# Derives monthly and yearly statistics from daily statistics of the same input, if another task computes these
+# daily statistics anyway. Only statistics for which this is exact are cascaded: minima, maxima and sums.
+def add_cascade_operators(commands, chains):
+    global log
+    day_nodes = set()
+    for root, chain in chains.values():
+        for i in range(len(chain)):
+            if chain[i][0] in daily_operators.values():
+                day_nodes.add((root, chain[:i + 1]))
+    for task, command in commands.iteritems():
+        if task not in chains or any([k for k in command.operators if k in daily_operators.values()]):
+            continue
+        coarse_keys = [k for k in command.operators if k in daily_operators]
+        if len(coarse_keys) != 1:
+            continue
+        day_key = daily_operators[coarse_keys[0]]
+        candidate = cdoapi.cdo_command()
+        candidate.operators = {k: list(v) for k, v in command.operators.iteritems()}
+        candidate.add_operator(day_key)
+        root, chain = chains[task][0], get_shared_chain(candidate)
+        for i in range(len(chain)):
+            if chain[i][0] == day_key and (root, chain[:i + 1]) in day_nodes:
+                log.info("Computing %s for variable %s in table %s from %s output" %
+                         (coarse_keys[0], task.target.variable, task.target.table, day_key))
+                commands[task] = candidate
+                chains[task] = (root, chain)
+                break
+
+
+# Returns the deepest materialized node of the operator chain
+def get_shared_input(materialized, root, chain):
+    for i in range(len(chain), 0, -1):
+        if (root, chain[:i]) in materialized:
+            return root, chain[:i]
+    return None
+
+
+# Releases the shared intermediate input of the task, the file is removed when no other task needs it anymore
+def release_intermediate(task):
+    intermediate = getattr(task, intermediate_key, None)
+    if intermediate is None:
+        return
+    delattr(task, intermediate_key)
+    release_file(intermediate[0])
+
+
+# Decrements the reference count of the intermediate file and removes it when it drops to zero
+def release_file(path):
+    with intermediates_lock:
+        count = intermediates.get(path, 0) - 1
+        if count > 0:
+            intermediates[path] = count
+            return
+        intermediates.pop(path, None)
+    if os.path.exists(path):
+        os.remove(path)
+
+
 # Checks whether the task grouping makes sense: only tasks for the same variable and frequency can be safely grouped.
 def validate_task_list(tasks):
     global log
@@ -73,33 +404,49 @@ def create_command(task):
 
 # Executes the command and replaces the path attribute for all tasks in the tasklist
 # to the output of cdo. This path is constructed from the basepath and the first task.
-def apply_command(command, task, output_path=None):
+def apply_command(command, task, output_path=None, in_memory=False, numpy_only=False):
     global log, cdo_threads, skip, append, recreate, mode
     if output_path is None and mode in [skip, append]:
         log.warning(
             "Executing post-processing in skip/append mode without path given: this will skip the entire task.")
-    input_files = getattr(task, cmor_task.filter_output_key, [])
-    if isinstance(input_files, str):
-        input_files = [input_files]
+    input_files = get_input_files(task)
+    intermediate = getattr(task, intermediate_key, None)
+    if intermediate is not None:
+        keys = command.get_operator_keys()
+        command.order = keys[:len(keys) - intermediate[1]]
     if not any(input_files):
         log.error("Cannot execute cdo command %s for given task because it has no model "
                   "output attribute" % command.create_command())
         return None
-    input_file = input_files[0]
-    if len(input_files) > 1:
-        directory = os.path.dirname(input_file)
-        input_file = os.path.join(directory, '_'.join([os.path.basename(f) for f in input_files]))
-        command.merge(input_files, input_file)
     comm_string = command.create_command()
-    log.info("Post-processing target %s in table %s from file %s with cdo command %s" % (
-        task.target.variable, task.target.table, input_file, comm_string))
     setattr(task, "cdo_command", comm_string)
     task.next_state()
     result = None
     if mode != skip:
         if mode == recreate or (mode == append and not os.path.exists(output_path)):
-            merge_expr = (cdoapi.cdo_command.set_code_operator in command.operators)
-            result = command.apply(input_file, output_path, cdo_threads, grib_first=merge_expr)
+            if in_memory and numpy_engine and output_path is not None:
+                result = numpyapi.apply(command, input_files, output_path)
+                if result is not None:
+                    log.info("Post-processed target %s in table %s from files %s in memory with operators %s" % (
+                        task.target.variable, task.target.table, str(input_files), comm_string))
+            if result is None:
+                input_file = input_files[0]
+                if len(input_files) > 1 and inline_merge:
+                    input_file = cdoapi.cdo_command.merge_input(input_files)
+                elif len(input_files) > 1:
+                    input_file = get_merge_path(input_files)
+                    command.merge(input_files, input_file)
+                log.info("Post-processing target %s in table %s from file %s with cdo command %s" % (
+                    task.target.variable, task.target.table, input_file, comm_string))
+                threads = getattr(task, threads_key, cdo_threads)
+                if in_memory and not numpy_only and output_path is not None and \
+                        fits_memory_budget(command, input_files):
+                    dataset = command.apply_cdf(input_file, threads)
+                    if dataset is not None:
+                        result = numpyapi.store_netcdf(output_path, dataset)
+                else:
+                    merge_expr = (cdoapi.cdo_command.set_code_operator in command.operators)
+                    result = command.apply(input_file, output_path, threads, grib_first=merge_expr)
             if not result:
                 task.set_failed()
     else:
@@ -110,6 +457,12 @@ def apply_command(command, task, output_path=None):
     return result
 
 
+# Returns the path of the merged file of the input files, when these are not merged within the cdo command
+def get_merge_path(input_files):
+    directory = os.path.dirname(input_files[0])
+    return os.path.join(directory, '_'.join([os.path.basename(f) for f in input_files]))
+
+
 # Checks whether the string expression denotes height level merging
 def add_expr_operators(cdo, task):
     expr = getattr(task.source, cmor_source.expression_key, None)
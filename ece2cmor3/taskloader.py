@@ -2,6 +2,7 @@ import csv
 import json
 import logging
 import os
+import numpy
 
 from ece2cmor3 import components
 from ece2cmor3 import ece2cmorlib, cmor_source, cmor_target, cmor_task
@@ -35,13 +36,14 @@ ignored_vars_file = os.path.join(os.path.dirname(__file__), "resources",
 identified_missing_vars_file = os.path.join(os.path.dirname(__file__), "resources",
                                             "list-of-identified-missing-cmpi6-requested-variables.xlsx")
 
-mask_predicates = {"=": lambda x, a: x == a,
-                   "==": lambda x, a: x == a,
-                   "!=": lambda x, a: x != a,
-                   "<": lambda x, a: x < a,
-                   "<=": lambda x, a: x <= a,
-                   ">": lambda x, a: x > a,
-                   ">=": lambda x, a: x >= a}
+# Mask comparison operators, numpy ufuncs that evaluate a whole field at once
+mask_predicates = {"=": numpy.equal,
+                   "==": numpy.equal,
+                   "!=": numpy.not_equal,
+                   "<": numpy.less,
+                   "<=": numpy.less_equal,
+                   ">": numpy.greater,
+                   ">=": numpy.greater_equal}
 
 skip_tables = False
 with_pingfile = False
@@ -40,6 +40,12 @@ type_axes_ = {}
 
 ps_tasks = {}
 
+# Surface pressure fields shared by the 3D variables
+ps_cache_ = cmor_utils.ps_cache()
+
+# Number of tasks still reading each surface pressure file, the file is closed in the cache when this drops to zero
+ps_consumers_ = {}
+
 time_axis_ids = {}
 type_axis_ids = {}
 depth_axis_ids = {}
@@ -237,6 +243,11 @@ def execute(tasks):
                 task.set_failed()
                 continue
     ps_tasks=get_ps_tasks(tasks)
+    ps_consumers_.clear()
+    for task in tasks:
+        pspath = getattr(getattr(task, 'ps_task', None), cmor_task.output_path_key, None)
+        if pspath:
+            ps_consumers_[pspath] = ps_consumers_.get(pspath, 0) + 1
 
     #group the taks according to table
     taskdict = cmor_utils.group(tasks,lambda t:t.target.table)
@@ -322,7 +333,10 @@ def execute(tasks):
             if(not executed):
                 log.error("ERR -14: The source variable %s of target %s in  table %s failed to cmorize" % (task.source.variable(),task.target.variable,task.target.table))
                 failed.append([task.target.variable,task.target.table])
+        for task in tasklist:
+            release_ps_var(task)
 
+    ps_cache_.close()
     if len(unit_miss_match)>0:
         log.info('Unit problems: %s'% unit_miss_match)
     if len(failed)>0:
@@ -430,7 +444,7 @@ def execute_netcdf_task(task,tableid):
     ## for pressure level variables we need to do interpolation, for which we need
     ## pyngl module
     if interpolate_to_pressure:
-        psdata=get_ps_var(getattr(getattr(task,'ps_task',None),cmor_task.output_path_key,None))
+        psdata=get_ps_var(getattr(getattr(task,'ps_task',None),cmor_task.output_path_key,None),task.target.frequency)
         pressure_levels=getattr(task,'pressure_levels')
         ncvar=interpolate_plev(pressure_levels,dataset,psdata,task.source.variable())
     else:  
@@ -459,11 +473,10 @@ def execute_netcdf_task(task,tableid):
         #  the data corresponds to the dimension definition of tables (from [-180 , 180] to [0,360] deg).)
         #  so by half the longitude dimension
         missval = getattr(ncvar,"missing_value",getattr(ncvar,"_FillValue",numpy.nan))
-        vals=numpy.copy(ncvar[:])
-        dims = numpy.shape(vals)
+        #  the roll is applied per chunk while writing, so the full field is never copied
+        dims = numpy.shape(ncvar)
         nroll=dims[-1]/2
-        ncvar = numpy.roll(vals,nroll,len(dims)-1)
-        vals=numpy.copy(ncvar[:,:,:])
+        ncvar = rolled_variable(ncvar,nroll)
     # Default values
     factor = 1.0
     term=0.0
@@ -471,9 +484,9 @@ def execute_netcdf_task(task,tableid):
     # 3D variables need the surface pressure for calculating the pressure at model levels
     if store_var:
         #get the ps-data associated with this data
-        psdata=get_ps_var(getattr(getattr(task,'ps_task',None),cmor_task.output_path_key,None))
-        # roll psdata like the original
-        psdata=numpy.roll(psdata[:],nroll,len(numpy.shape(psdata[:]))-1)
+        psdata=get_ps_var(getattr(getattr(task,'ps_task',None),cmor_task.output_path_key,None),task.target.frequency)
+        # roll psdata like the original, chunk by chunk from the shared cache
+        psdata=rolled_variable(psdata,nroll)
         cmor_utils.netcdf2cmor(varid, ncvar, timdim, factor, term, store_var, psdata,
                                swaplatlon=False, fliplat=True, mask=None,missval=missval)
     else:
@@ -551,12 +564,23 @@ def interpolate_plev(pressure_levels,dataset,psdata,varname):
 
     hybm = dataset.variables["hybm"][:]
     hybm = hybm[::-1]
-    # Vertical coordinate must be from top to bottom: [::-1]
-    data   = dataset.variables[varname][:,:,:,:]
-    data = data[:,::-1,:,:]
-
     interpolation=1 #1 linear, 2 log, 3 loglog
-    interpolated_data = Ngl.vinth2p(data,hyam,hybm,pressure_levels,psdata[:,:,:],interpolation,p0mb,1,True)
+    # Interpolate in blocks of time steps that match the blocks of the surface pressure cache, so neither the input
+    # nor the surface pressure is loaded as a whole
+    ncvar = dataset.variables[varname]
+    ntimes = ncvar.shape[0]
+    block_steps = getattr(psdata, "block_steps", ntimes)
+    interpolated_data = None
+    for start in range(0, ntimes, block_steps):
+        stop = min(start + block_steps, ntimes)
+        # Vertical coordinate must be from top to bottom: [::-1]
+        data = ncvar[start:stop,:,:,:]
+        data = data[:,::-1,:,:]
+        block = Ngl.vinth2p(data,hyam,hybm,pressure_levels,psdata[start:stop,:,:],interpolation,p0mb,1,True)
+        if interpolated_data is None:
+            empty = numpy.ma.empty if isinstance(block, numpy.ma.MaskedArray) else numpy.empty
+            interpolated_data = empty((ntimes,) + block.shape[1:], dtype=block.dtype)
+        interpolated_data[start:stop] = block
     return interpolated_data
 
 
@@ -861,12 +885,14 @@ def create_lon():
     return lon_id
     
 # Surface pressure variable lookup utility
-def get_ps_var(ncpath):
+def get_ps_var(ncpath, frequency=None):
     """ read surface pressure variable for 3D output
     Args:
         ncpath (string): full path to ps_*.nc file
+        frequency (string): frequency of the surface pressure, the variable is cached per path and frequency
     Returns:
-        numpy-array: [lon,lat,time]-array containing surface pressure values  
+        cached netcdf-variable: [time,lat,lon]-variable containing surface pressure values, read through the shared
+        surface pressure cache
     """
 
     if not ncpath:
@@ -875,18 +901,59 @@ def get_ps_var(ncpath):
     if not os.path.exists(ncpath):
         log.error("ERR -3: Path does not exist for surface pressure (ps).")
         return None
-    ds = None
     try:
-        ds = netCDF4.Dataset(ncpath)
-        if "ps" in ds.variables:
-            return ds.variables["ps"]
-        else:
+        psvar = ps_cache_.get_variable(ncpath, lambda ds: ds.variables.get("ps", None), frequency)
+        if psvar is None:
             log.error("ERR -4: Variable ps not present in pressure file.")
-            return None
+        return psvar
     except Exception as e:
         log.error("ERR -5: Could not read netcdf file %s for surface pressure, reason: %s" % (ncpath, e.message))
         return None
 
+def release_ps_var(task):
+    """ release the surface pressure of a task
+    Args:
+        task (cmor.task): task that no longer needs its surface pressure
+    Description:
+        the surface pressure file is closed in the shared cache when its last consumer has been released
+    """
+    pspath = getattr(getattr(task, 'ps_task', None), cmor_task.output_path_key, None)
+    if pspath not in ps_consumers_:
+        return
+    ps_consumers_[pspath] -= 1
+    if ps_consumers_[pspath] <= 0:
+        del ps_consumers_[pspath]
+        ps_cache_.close(pspath)
+
+
+class rolled_variable(object):
+    """ lazily rolled [time,...,lon] variable
+    Description:
+        wraps a netcdf variable or array whose last dimension is rolled by shift when it is read, so that only the
+        requested slab is copied instead of the full field
+    """
+
+    def __init__(self, ncvar, shift):
+        self.ncvar = ncvar
+        self.shift = shift
+        self.shape = tuple(numpy.shape(ncvar))
+        self.ndim = len(self.shape)
+        self.size = numpy.prod(self.shape)
+        self.dtype = ncvar.dtype
+        self.block_steps = getattr(ncvar, "block_steps", self.shape[0])
+
+    def __getitem__(self, index):
+        index = index if isinstance(index, tuple) else (index,)
+        if any([i is Ellipsis for i in index]):
+            i = [i is Ellipsis for i in index].index(True)
+            index = index[:i] + (slice(None),) * (self.ndim - len(index) + 1) + index[i + 1:]
+        index = index + (slice(None),) * (self.ndim - len(index))
+        data = numpy.roll(numpy.asarray(self.ncvar[index[:-1] + (slice(None),)]), self.shift, -1)
+        if isinstance(index[-1], slice) and index[-1] == slice(None):
+            return data
+        return data[..., index[-1]]
+
+
 # Creates extra tasks for surface pressure
 def get_ps_tasks(tasks):
     """ find ps (surface preseure) tasks for different tables
@@ -1,4 +1,6 @@
 import logging
+import netCDF4
+import os
 import unittest
 from ece2cmor3 import cdoapi
 import nose.tools
@@ -90,3 +92,46 @@ class cdoapi_tests(unittest.TestCase):
         command.add_operator(cdoapi.cdo_command.month + cdoapi.cdo_command.mean)
         commstr = command.create_command()
         nose.tools.eq_("-expr,'var91=sq(var130)' -monmean -selcode,130", commstr)
+
+    def test_explicit_order(self):
+        command = cdoapi.cdo_command(130)
+        command.add_operator(cdoapi.cdo_command.spectral_operator)
+        command.add_operator(cdoapi.cdo_command.day + cdoapi.cdo_command.mean)
+        nose.tools.eq_("-sp2gpl -daymean -selcode,130", command.create_command())
+        keys = command.get_operator_keys()
+        command.order = keys[:-1]
+        nose.tools.eq_("-sp2gpl -daymean", command.create_command())
+
+    def test_metadata_cache(self):
+        path = os.path.join(os.path.dirname(__file__), "tmp", "metadata_cache_test.txt")
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write("a")
+        calls = []
+        query = lambda: calls.append(1) or [len(calls)]
+        nose.tools.eq_(cdoapi.query_metadata(path, "test", query), [1])
+        nose.tools.eq_(cdoapi.query_metadata(path, "test", query), [1])
+        with open(path, 'a') as f:
+            f.write("b")
+        nose.tools.eq_(cdoapi.query_metadata(path, "test", query), [2])
+        os.remove(path)
+
+    def test_set_netcdf_code(self):
+        path = os.path.join(os.path.dirname(__file__), "tmp", "set_code_test.nc")
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        ds = netCDF4.Dataset(path, 'w', format="NETCDF3_CLASSIC")
+        ds.createDimension("time", None)
+        ds.createDimension("lat", 2)
+        ds.createDimension("lon", 3)
+        ds.createVariable("time", "f8", ("time",))
+        ds.createVariable("lat", "f8", ("lat",))
+        ds.createVariable("lon", "f8", ("lon",))
+        ds.createVariable("t2m", "f4", ("time", "lat", "lon"))
+        ds.close()
+        nose.tools.eq_(cdoapi.set_netcdf_code(path, [91]), True)
+        ds = netCDF4.Dataset(path, 'r')
+        nose.tools.eq_(ds.variables["var91"].code, 91)
+        ds.close()
+        os.remove(path)
@@ -8,10 +8,38 @@ import numpy
 from dateutil.relativedelta import relativedelta
 from nose.tools import eq_, ok_, raises
 from ece2cmor3.cmor_utils import make_time_intervals, find_ifs_output, get_ifs_date, find_nemo_output, get_nemo_grid, \
-    group, num2num
+    group, num2num, get_time_slice_map, get_time_runs, get_itemsize, get_step_bytes, get_chunk_size, \
+    apply_mask, get_cmor_axes
+from ece2cmor3 import cmor_utils
 
 logging.basicConfig(level=logging.DEBUG)
 
+# Output axes of the former per-rank netcdf2cmor branches, keyed by rank and time dimension, without and with the
+# latitude-longitude swap
+legacy_axes = {(1, 0): ([0], [0]), (2, -1): ([0, 1], [1, 0]), (2, 0): ([1, 0], [1, 0]), (2, 1): ([0, 1], [0, 1]),
+               (3, -1): ([1, 2, 0], [2, 1, 0]), (3, 0): ([1, 2, 0], [2, 1, 0]), (3, 2): ([0, 1, 2], [1, 0, 2]),
+               (4, 0): ([2, 3, 1, 0], [3, 2, 1, 0]), (4, 3): ([0, 1, 2, 3], [1, 0, 2, 3]),
+               (5, 0): ([3, 4, 2, 1, 0], [4, 3, 2, 1, 0]), (5, 4): ([0, 1, 2, 3, 4], [1, 0, 2, 3, 4])}
+
+
+# Returns the data the former netcdf2cmor wrote for the array in total, in cmor order with time last: rescaled values,
+# masked for time-first and constant input, missing time steps filled and the first output axis flipped
+def get_legacy_output(data, timdim, time_selection, swaplatlon, fliplat, mask, factor, term, missval):
+    vals = data * factor + term
+    if mask is not None and timdim <= 0 and not (vals.ndim == 2 and timdim == 0):
+        vals = numpy.where(mask, vals, missval)
+    if timdim >= 0 and time_selection is not None:
+        vals = numpy.take(vals, numpy.maximum(time_selection, 0), axis=timdim)
+        gaps = (time_selection < 0).reshape([-1 if d == timdim else 1 for d in range(vals.ndim)])
+        vals = numpy.where(gaps, missval, vals)
+    vals = numpy.transpose(vals, legacy_axes[(vals.ndim, timdim)][1 if swaplatlon else 0])
+    if fliplat and (vals.ndim > 1 or timdim < 0):
+        vals = vals[::-1, ...]
+    if timdim < 0:
+        ntimes = 1 if time_selection is None else len(time_selection)
+        vals = numpy.repeat(vals[..., numpy.newaxis], ntimes, axis=-1)
+    return vals
+
 
 class utils_tests(unittest.TestCase):
 
@@ -153,3 +181,129 @@ class utils_tests(unittest.TestCase):
         nums = netCDF4.date2num(times, units, calender)
         dates = netCDF4.num2date(nums, units, calender)
         ok_(not isinstance(dates[0], datetime.datetime))
+
+    @staticmethod
+    def test_time_slice_map():
+        start = datetime.datetime(2000, 1, 1)
+        times = [start + datetime.timedelta(hours=6 * i) for i in range(8) if i != 5]
+        bounds = [(start + datetime.timedelta(hours=6 * i), start + datetime.timedelta(hours=6 * i + 3))
+                  for i in range(8)]
+        eq_(list(get_time_slice_map(times, bounds)), [0, 1, 2, 3, 4, -1, 5, 6])
+        eq_(list(get_time_slice_map(times[::-1], bounds)), [6, 5, 4, 3, 2, -1, 1, 0])
+
+    @staticmethod
+    def test_time_runs():
+        selection = numpy.array([0, 1, 2, -1, -1, 4, 5, 6, 8, -1])
+        runs = get_time_runs(selection, len(selection), 4)
+        eq_([(r[0], r[1]) for r in runs], [(0, 3), (3, 5), (5, 9), (9, 10)])
+        eq_(runs[0][2], slice(0, 3, 1))
+        eq_(runs[1][2], None)
+        eq_(list(runs[2][2]), [4, 5, 6, 8])
+
+    @staticmethod
+    def test_chunk_size():
+        eq_(get_itemsize(numpy.zeros(4, dtype=numpy.float32)), 4)
+        eq_(get_step_bytes(100, 4), 1300)
+        cmor_utils.memory_budget = 13000
+        try:
+            eq_(get_chunk_size(get_step_bytes(100, 4)), 10)
+            eq_(get_chunk_size(get_step_bytes(100, 8)), 5)
+            eq_(get_chunk_size(get_step_bytes(10000, 8)), 1)
+        finally:
+            cmor_utils.memory_budget = None
+
+    @staticmethod
+    def test_apply_mask():
+        array = numpy.array([[[1., 7.], [3., 4.]], [[5., 6.], [7., 1.e+20]]], dtype=numpy.float32)
+        mask = numpy.array([[True, True], [False, True]])
+        cmor_utils.mask_block_size = 4
+        try:
+            result = apply_mask(array, 2.0, 1.0, mask, 7., 1.e+20)
+        finally:
+            cmor_utils.mask_block_size = 2 ** 20
+        ok_(result is array)
+        expected = numpy.array([[[3., 1.e+20], [1.e+20, 9.]], [[11., 13.], [1.e+20, 1.e+20]]], dtype=numpy.float32)
+        numpy.testing.assert_array_equal(result, expected)
+
+    @staticmethod
+    def test_cmor_axes():
+        eq_(get_cmor_axes(1, 0, False), [0])
+        eq_(get_cmor_axes(2, -1, True), [1, 0])
+        eq_(get_cmor_axes(3, 0, False), [1, 2, 0])
+        eq_(get_cmor_axes(3, 2, True), [1, 0, 2])
+        eq_(get_cmor_axes(4, 0, True), [3, 2, 1, 0])
+        eq_(get_cmor_axes(5, 0, False), [3, 4, 2, 1, 0])
+
+    @staticmethod
+    def test_ps_cache():
+        path = os.path.join(os.path.dirname(__file__), "tmp", "ps_cache_test.nc")
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        ds = netCDF4.Dataset(path, 'w')
+        ds.createDimension("time", None)
+        ds.createDimension("lat", 2)
+        ds.createDimension("lon", 3)
+        ps = numpy.arange(10 * 2 * 3, dtype=numpy.float32).reshape((10, 2, 3))
+        ds.createVariable("ps", "f4", ("time", "lat", "lon"))[0:10] = ps
+        ds.close()
+        cmor_utils.memory_budget = 4 * 4 * 6 * 3
+        try:
+            cache = cmor_utils.ps_cache(fraction=1.0)
+            psvar = cache.get_variable(path, lambda d: d.variables["ps"], "6hr")
+            ok_(cache.get_variable(path, lambda d: d.variables["ps"], "6hr") is psvar)
+            eq_(psvar.block_steps, 3)
+            numpy.testing.assert_array_equal(psvar[2:8, ::-1, :], ps[2:8, ::-1, :])
+            numpy.testing.assert_array_equal(psvar[:], ps)
+            ok_(cache.nbytes <= cache.get_budget())
+            cache.close()
+            eq_(len(cache.blocks), 0)
+            eq_(len(cache.datasets), 0)
+        finally:
+            cmor_utils.memory_budget = None
+            os.remove(path)
+
+    @staticmethod
+    def test_netcdf2cmor_layouts():
+        writes = []
+
+        def write(varid, vals, ntimes_passed=0, store_with=None):
+            writes.append((varid, numpy.array(vals), ntimes_passed))
+
+        cmor_write = getattr(cmor_utils.cmor, "write", None)
+        cmor_utils.cmor.write = write
+        cmor_utils.memory_budget = 3000
+        rng = numpy.random.RandomState(0)
+        selection = numpy.array([0, 1, 2, -1, -1, 4, 5, 6, 8, 9, -1])
+        try:
+            for ndims, timdim in sorted(legacy_axes.keys()):
+                shape = [12 if d == timdim else [2, 2, 2, 3, 4][d - ndims] for d in range(ndims)]
+                for sel in ([None] if ndims == 1 else [None, selection]):
+                    for swap, flip, masked in [(s, f, m) for s in [False, True] for f in [False, True]
+                                               for m in [False, True]]:
+                        data = rng.rand(*shape)
+                        mask = rng.rand(*shape[-2:]) < 0.5 if masked and ndims > 1 else None
+                        ps = rng.rand(12, 3, 4) if (ndims, timdim) == (4, 0) else None
+                        del writes[:]
+                        source = data.copy()
+                        cmor_utils.netcdf2cmor(1, source, timdim, factor=2., term=1., psvarid=2, ncpsvar=ps,
+                                               swaplatlon=swap, fliplat=flip, mask=mask, time_selection=sel)
+                        numpy.testing.assert_array_equal(source, data)
+                        expected = get_legacy_output(data, timdim, sel, swap, flip, mask, 2., 1., 1.e+20)
+                        if timdim < 0:
+                            eq_(len([w for w in writes if w[0] == 1]), 1)
+                        ntimes = expected.shape[-1]
+                        eq_(sum([w[2] for w in writes if w[0] == 1]), ntimes if (timdim >= 0 or sel is not None)
+                            else 0)
+                        written = [w[1].reshape(expected.shape[:-1] + (-1,)) for w in writes if w[0] == 1]
+                        numpy.testing.assert_array_equal(numpy.concatenate(written, axis=-1), expected)
+                        if ps is not None:
+                            expected_ps = numpy.transpose(ps[:ntimes], [2, 1, 0] if swap else [1, 2, 0])
+                            written_ps = [w[1] for w in writes if w[0] == 2]
+                            numpy.testing.assert_array_equal(numpy.concatenate(written_ps, axis=-1),
+                                                             expected_ps[::-1, ...] if flip else expected_ps)
+        finally:
+            cmor_utils.memory_budget = None
+            if cmor_write is None:
+                del cmor_utils.cmor.write
+            else:
+                cmor_utils.cmor.write = cmor_write
@@ -1,6 +1,9 @@
 from datetime import datetime
 
+import glob
 import logging
+import multiprocessing
+import shutil
 import unittest
 
 import os
@@ -12,6 +15,7 @@ logging.basicConfig(level=logging.DEBUG)
 
 test_data_path = os.path.join(os.path.dirname(__file__), "test_data", "ifs", "001")
 tmp_path = os.path.join(os.path.dirname(__file__), "tmp")
+index_path = os.path.join(tmp_path, "index")
 
 
 def setup():
@@ -20,6 +24,38 @@ def setup():
         os.makedirs(tmp_path)
 
 
+# Removes the stored message indices and forgets the cached ones, so every test creates its own in index_path
+def remove_indices():
+    grib_filter.indices = {}
+    if os.path.exists(index_path):
+        shutil.rmtree(index_path)
+    for path in glob.glob(os.path.join(tmp_path, "*.idx")):
+        os.remove(path)
+
+
+# Writes a two month copy of the test data to the temporary directory, the second month repeats the first month's
+# records for the days that exist in february. Returns the gridpoint and spectral file dictionaries.
+def create_two_month_data():
+    data_path = os.path.join(tmp_path, "ifs", "001")
+    if not os.path.exists(data_path):
+        os.makedirs(data_path)
+    gg_paths, sh_paths = {}, {}
+    for prefix, paths in [("ICMGGECE3", gg_paths), ("ICMSHECE3", sh_paths)]:
+        src = os.path.join(test_data_path, prefix + "+199001.csv")
+        shutil.copy(src, data_path)
+        paths[datetime(year=1990, month=1, day=1)] = os.path.join(data_path, os.path.basename(src))
+        dst = os.path.join(data_path, prefix + "+199002.csv")
+        with open(src) as fin, open(dst, 'w') as fout:
+            for line in fin:
+                date = line[:8]
+                if date == "19900201":
+                    fout.write("19900301" + line[8:])
+                elif int(date[6:]) <= 28:
+                    fout.write("199002" + date[6:] + line[8:])
+        paths[datetime(year=1990, month=2, day=1)] = dst
+    return gg_paths, sh_paths
+
+
 class grib_filter_test(unittest.TestCase):
     test_mode = True
     date = datetime(year=1990, month=1, day=1, hour=1)
@@ -28,6 +64,10 @@ class grib_filter_test(unittest.TestCase):
     sh_file = "ICMSHECE3+199001.csv" if test_mode else "ICMSHECE3+199001"
     sh_path = {date: os.path.join(test_data_path, sh_file)}
 
+    @classmethod
+    def tearDownClass(cls):
+        remove_indices()
+
     @staticmethod
     @with_setup(setup)
     def test_initialize():
@@ -36,6 +76,48 @@ class grib_filter_test(unittest.TestCase):
         eq_(grib_filter.varsfreq[(133, 128, grib_file.pressure_level_Pa_code, 85000, cmor_source.ifs_grid.point)], 6)
         eq_(grib_filter.varsfreq[(164, 128, grib_file.surface_level_code, 0, cmor_source.ifs_grid.point)], 3)
 
+    @staticmethod
+    @with_setup(setup)
+    def test_manifest():
+        manifest = os.path.join(tmp_path, "test-ifs-manifest.json")
+        if os.path.exists(manifest):
+            os.remove(manifest)
+        grib_filter.varsfreq = {}
+        remove_indices()
+        try:
+            grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, tmp_path,
+                                   indexdir=index_path, manifest=manifest)
+            ok_(os.path.isfile(manifest))
+            ok_(any(glob.glob(os.path.join(index_path, "*.idx"))))
+            varsfreq = grib_filter.varsfreq
+            grib_filter.varsfreq = {}
+            grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, tmp_path,
+                                   indexdir=index_path, manifest=manifest)
+            eq_(grib_filter.varsfreq, varsfreq)
+        finally:
+            os.remove(manifest)
+            remove_indices()
+
+    @staticmethod
+    @with_setup(setup)
+    def test_message_index():
+        path = grib_filter_test.gg_path.values()[0]
+        index = grib_file.create_index(path)
+        with open(path) as fin:
+            reader = grib_file.create_grib_file(fin)
+            indexed_reader = grib_file.create_grib_file(fin, index)
+            num_messages = 0
+            while indexed_reader.read_next(headers_only=True):
+                ok_(reader.read_next())
+                for key in grib_file.index_columns[2:]:
+                    eq_(indexed_reader.get_field(key), reader.get_field(key))
+                num_messages += 1
+            eq_(num_messages, len(index))
+        index_path = os.path.join(tmp_path, "test_message_index.idx")
+        grib_file.write_index(index, path, index_path)
+        eq_(grib_file.read_index(path, index_path), index)
+        os.remove(index_path)
+
     @staticmethod
     @with_setup(setup)
     def test_validate_tasks():
@@ -141,6 +223,79 @@ class grib_filter_test(unittest.TestCase):
                     time = newtime
         os.remove(filepath)
 
+    @staticmethod
+    @with_setup(setup)
+    def test_parallel_filter():
+        remove_indices()
+        gg_paths, sh_paths = create_two_month_data()
+        grib_filter.initialize(gg_paths, sh_paths, tmp_path, indexdir=index_path)
+        jan, feb = sorted(gg_paths.keys())
+        grib_filter.gridpoint_files[feb] = (gg_paths[jan], gg_paths[feb])
+        grib_filter.spectral_files[feb] = (sh_paths[jan], sh_paths[feb])
+        ece2cmorlib.initialize()
+        targets = [("clwvi", "CFday", "79.128"), ("ua", "Amon", "131.128"), ("pr", "Amon", "228.128")]
+        results = []
+        pool = multiprocessing.Pool(processes=3)
+        try:
+            for nprocs, procs_pool in [(1, None), (3, None), (3, pool)]:
+                tasks = [cmor_task.cmor_task(cmor_source.ifs_source.read(c), ece2cmorlib.get_cmor_target(v, t))
+                         for v, t, c in targets]
+                grib_filter.execute(tasks, nprocs=nprocs, pool=procs_pool)
+                contents = {}
+                for tsk in tasks:
+                    for filepath in getattr(tsk, cmor_task.filter_output_key):
+                        with open(filepath) as fin:
+                            contents[filepath] = fin.read()
+                        os.remove(filepath)
+                results.append(contents)
+        finally:
+            pool.close()
+            pool.join()
+            remove_indices()
+            shutil.rmtree(os.path.join(tmp_path, "ifs"))
+        ok_(any(["19900215" in c for c in results[0].values()]))
+        for contents in results[1:]:
+            eq_(sorted(results[0].keys()), sorted(contents.keys()))
+            for filepath in results[0]:
+                ok_(any(results[0][filepath]))
+                eq_(results[0][filepath], contents[filepath])
+        ok_(not any([f for f in os.listdir(tmp_path) if ".part." in f]))
+
+    @staticmethod
+    @with_setup(setup)
+    def test_output_file_pool():
+        fnames = ["pool_test_%d" % i for i in range(3)]
+        pool = grib_filter.output_file_pool({f: os.path.join(tmp_path, f) for f in fnames}, 1)
+        pool.block_size = 10
+        for i in range(20):
+            for f in fnames:
+                pool.get(f).write("%s:%d\n" % (f, i))
+                ok_(len(pool.handles) <= 1)
+        del pool[fnames[0]]
+        ok_(fnames[0] not in pool)
+        for handle in pool.values():
+            handle.close()
+        for f in fnames:
+            with open(os.path.join(tmp_path, f)) as fin:
+                eq_(fin.read(), "".join(["%s:%d\n" % (f, i) for i in range(20)]))
+            os.remove(os.path.join(tmp_path, f))
+
+    @staticmethod
+    def test_filter_batches():
+        tasks = [cmor_task.cmor_task(cmor_source.ifs_source.read(c), cmor_target.cmor_target(v, "Amon"))
+                 for v, c in [("tas", "167.128"), ("pr", "228.128"), ("ps", "134.128"), ("huss", "133.128")]]
+        task2files = {tasks[0]: ["167.128.105.3"], tasks[1]: ["228.128.1.3", "167.128.105.3"],
+                      tasks[2]: ["134.128.1.3"], tasks[3]: ["133.128.105.3"]}
+        keys2files = {(c, 128, 1, 0, 0): {(f, 3)} for c, f in [(167, "167.128.105.3"), (228, "228.128.1.3"),
+                                                              (134, "134.128.1.3"), (133, "133.128.105.3")]}
+        batches = grib_filter.get_filter_batches(keys2files, task2files, 3, priority_tasks=[tasks[2]])
+        eq_(len(batches), 3)
+        eq_(batches[0][1], [tasks[2]])
+        eq_(batches[0][0].keys(), [(134, 128, 1, 0, 0)])
+        eq_(sorted([len(b[1]) for b in batches]), [1, 1, 2])
+        ok_(any([set(b[1]) == {tasks[0], tasks[1]} for b in batches]))
+        eq_(sum([len(b[0]) for b in batches]), len(keys2files))
+
     @staticmethod
     @with_setup(setup)
     def test_prev_month_find():
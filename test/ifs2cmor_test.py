@@ -6,10 +6,11 @@ import logging
 import netCDF4
 import numpy
 import os
+import subprocess
 import unittest
 from nose.tools import eq_
 
-from ece2cmor3 import ifs2cmor, ece2cmorlib
+from ece2cmor3 import ifs2cmor, ece2cmorlib, cmor_task, cmor_source, cmor_target, grib_file, numpyapi
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -128,3 +129,130 @@ class ifs2cmor_tests(unittest.TestCase):
         eq_(lower_bnds, [self.startdate + n * interval for n in range(0, 4 * 365)])
         eq_(upper_bnds, lower_bnds)
         os.remove(filepath)
+
+    def test_tmp_file_tracking(self):
+        ifs2cmor.temp_dir_ = self.temp_dir
+        ifs2cmor.ifs_gridpoint_files_, ifs2cmor.ifs_spectral_files_ = {}, {}
+        paths = [os.path.join(self.temp_dir, f) for f in ["130.128.105.6", "131.128.105.6"]]
+        for path in paths:
+            with open(path, 'w') as ofile:
+                ofile.write("x" * 100)
+        task1 = cmor_task.cmor_task(cmor_source.ifs_source.create(130), cmor_target.cmor_target("ta", "Amon"))
+        task2 = cmor_task.cmor_task(cmor_source.ifs_source.create(131), cmor_target.cmor_target("ua", "Amon"))
+        ifs2cmor.tmp_consumers.clear()
+        ifs2cmor.tmp_usage.update({"current": 0, "peak": 0})
+        ifs2cmor.register_tmp_files(task1, paths)
+        ifs2cmor.register_tmp_files(task2, paths[1:] + ["/tmp/other.grb"])
+        eq_(ifs2cmor.tmp_usage["current"], 200)
+        ifs2cmor.release_tmp_files(task1)
+        eq_([os.path.exists(p) for p in paths], [False, True])
+        ifs2cmor.release_tmp_files(task2)
+        eq_(os.path.exists(paths[1]), False)
+        eq_(ifs2cmor.tmp_usage["current"], 0)
+        eq_(ifs2cmor.tmp_usage["peak"], 200)
+
+    def test_sp_file_release(self):
+        ifs2cmor.temp_dir_ = self.temp_dir
+        ifs2cmor.ifs_gridpoint_files_, ifs2cmor.ifs_spectral_files_ = {}, {}
+        path = os.path.join(self.temp_dir, "ps_Amon.nc")
+        root = netCDF4.Dataset(path, "w")
+        root.createDimension("time", 4)
+        root.createDimension("lat", 2)
+        root.createDimension("lon", 3)
+        root.createVariable("var134", "f4", ("time", "lat", "lon"))[:] = numpy.ones((4, 2, 3))
+        root.close()
+        task1 = cmor_task.cmor_task(cmor_source.ifs_source.create(130), cmor_target.cmor_target("ta", "Amon"))
+        task2 = cmor_task.cmor_task(cmor_source.ifs_source.create(131), cmor_target.cmor_target("ua", "Amon"))
+        ifs2cmor.tmp_consumers.clear()
+        for task in [task1, task2]:
+            ifs2cmor.register_tmp_files(task, [path])
+        spvar = ifs2cmor.get_sp_var(path, "mon")
+        eq_(spvar[0:2].shape, (2, 2, 3))
+        ifs2cmor.release_tmp_files(task1)
+        eq_(path in ifs2cmor.sp_cache.datasets, True)
+        ifs2cmor.release_tmp_files(task2)
+        eq_(path in ifs2cmor.sp_cache.datasets, False)
+        eq_(os.path.exists(path), False)
+
+    def test_time_selection_release(self):
+        ifs2cmor.temp_dir_ = self.temp_dir
+        ifs2cmor.ifs_gridpoint_files_, ifs2cmor.ifs_spectral_files_ = {}, {}
+        path = os.path.join(self.temp_dir, "tas_Amon.nc")
+        root = netCDF4.Dataset(path, "w")
+        root.createDimension("time", 3)
+        time_variable = root.createVariable("time", "f8", dimensions=("time",))
+        time_variable.units = "days since 1990-01-01 00:00:00"
+        time_variable[:] = [15., 45., 74.]
+        root.close()
+        bnds = [(datetime.datetime(1990, m, 1), datetime.datetime(1990, m + 1, 1)) for m in range(1, 5)]
+        task = cmor_task.cmor_task(cmor_source.ifs_source.create(167), cmor_target.cmor_target("tas", "Amon"))
+        ifs2cmor.tmp_consumers.clear()
+        ifs2cmor.time_selections.clear()
+        ifs2cmor.register_tmp_files(task, [path])
+        eq_(list(ifs2cmor.get_time_selection(path, 1, bnds)), [0, 1, 2, -1])
+        eq_(ifs2cmor.time_selections.keys(), [(path, 1)])
+        ifs2cmor.release_tmp_files(task)
+        eq_(ifs2cmor.time_selections, {})
+
+    def test_mask_path(self):
+        grib_file.test_mode = True
+        ifs2cmor.mask_dir_ = self.temp_dir
+        source = cmor_source.ifs_source.create(172)
+        ifs2cmor.masks = {"lsm": {"source": source, "operator": numpy.greater, "rhs": 0.5}}
+        paths = []
+        for date in ["19900201", "19900301"]:
+            path = os.path.join(self.temp_dir, "172.128.1.0." + date)
+            with open(path, 'w') as ofile:
+                ofile.write("%s,0,172,1,0\n%s,600,172,1,0\n" % (date, date))
+            paths.append(path)
+        task = cmor_task.cmor_task(source, cmor_target.cmor_target("lsm", "fx"))
+        mask_paths = []
+        for path in paths:
+            setattr(task, cmor_task.filter_output_key, path)
+            mask_paths.append(ifs2cmor.get_mask_path(task))
+        eq_(mask_paths[0] is not None, True)
+        eq_(mask_paths[0], mask_paths[1])
+        ifs2cmor.masks["lsm"]["rhs"] = 0.25
+        eq_(ifs2cmor.get_mask_path(task) == mask_paths[1], False)
+        for path in paths:
+            os.remove(path)
+
+    def test_mask_release(self):
+        source = cmor_source.ifs_source.create(172)
+        ifs2cmor.masks = {"lsm": {"source": source, "operator": numpy.greater, "rhs": 0.5}}
+        cdf_path = os.path.join(self.temp_dir, "cdo_output.nc")
+        root = netCDF4.Dataset(cdf_path, "w")
+        root.createDimension("lat", 2)
+        root.createDimension("lon", 3)
+        root.createVariable("var172", "f4", ("lat", "lon"))[:] = [[0., 1., 1.], [0., 0., 1.]]
+        root.close()
+        path = os.path.join(self.temp_dir, "lsm_fx.nc")
+        numpyapi.store_netcdf(path, netCDF4.Dataset(cdf_path, "r"))
+        mask_path = os.path.join(self.temp_dir, "masks", "lsm.npy")
+        ifs2cmor.read_mask("lsm", path, mask_path)
+        eq_(ifs2cmor.masks["lsm"]["array"].tolist(), [[False, True, True], [False, False, True]])
+        eq_(numpyapi.get_dataset(path), None)
+        eq_(os.path.exists(cdf_path), False)
+        eq_(numpy.load(mask_path).tolist(), ifs2cmor.masks["lsm"]["array"].tolist())
+        os.remove(mask_path)
+        os.rmdir(os.path.dirname(mask_path))
+
+    def test_lost_jobs(self):
+        class job(object):
+            def __init__(self, ready, successful=True):
+                self.is_ready, self.is_successful = ready, successful
+
+            def ready(self):
+                return self.is_ready
+
+            def successful(self):
+                return self.is_successful
+
+        process = subprocess.Popen(["true"])
+        process.wait()
+        jobs = {1: ("done", job(True)), 2: ("failed", job(True, False)), 3: ("running", job(False)),
+                4: ("died", job(False))}
+        workers = {3: os.getpid(), 4: process.pid, 5: os.getpid()}
+        eq_(sorted(ifs2cmor.get_lost_jobs(jobs, workers, None)), ["died", "failed"])
+        eq_(sorted(jobs.keys()), [1, 3])
+        eq_(workers, {3: os.getpid()})
@@ -0,0 +1,111 @@
+import datetime
+import logging
+import unittest
+import numpy
+from ece2cmor3 import cdoapi, numpyapi
+import nose.tools
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+def make_series(times, fields, grid):
+    series = numpyapi.field_series()
+    series.code = 167
+    series.grid = grid
+    series.times = times
+    series.fields = fields
+    return series
+
+
+class numpyapi_tests(unittest.TestCase):
+
+    @staticmethod
+    def test_supported_command():
+        command = cdoapi.cdo_command(167)
+        command.add_operator(cdoapi.cdo_command.gridtype_operator, cdoapi.cdo_command.regular_grid_type)
+        command.add_operator(cdoapi.cdo_command.day + cdoapi.cdo_command.mean)
+        nose.tools.eq_(numpyapi.supports(command), True)
+        command.add_operator(cdoapi.cdo_command.spectral_operator)
+        nose.tools.eq_(numpyapi.supports(command), False)
+
+    @staticmethod
+    def test_gaussian_latitudes():
+        lats = numpyapi.get_gaussian_latitudes(16)
+        nose.tools.eq_(len(lats), 32)
+        nose.tools.eq_(lats[0] > 0, True)
+        numpy.testing.assert_allclose(lats, -lats[::-1], atol=1.e-12)
+
+    @staticmethod
+    def test_interpolate_reduced():
+        pl = (4, 8, 8, 4)
+        interpolation = numpyapi.get_interpolation(pl, 8)
+        rows = [numpy.arange(n, dtype=numpy.float32) for n in pl]
+        result = numpyapi.interpolate_reduced(numpy.concatenate(rows), interpolation)
+        nose.tools.eq_(result.shape, (4, 8))
+        numpy.testing.assert_allclose(result[1, :], rows[1])
+        numpy.testing.assert_allclose(result[0, :], [0., 0.5, 1., 1.5, 2., 2.5, 3., 1.5])
+
+    @staticmethod
+    def test_daily_mean():
+        times = [datetime.datetime(2000, 1, 1) + datetime.timedelta(hours=3 * i) for i in range(16)]
+        fields = [numpy.full((2, 4), i, dtype=numpy.float32) for i in range(16)]
+        series = make_series(times, fields, ("regular", 1, 4))
+        numpyapi.apply_operator(series, cdoapi.cdo_command.day + cdoapi.cdo_command.mean, [])
+        nose.tools.eq_(len(series.fields), 2)
+        nose.tools.eq_(series.times[0], datetime.datetime(2000, 1, 1, 10, 30))
+        numpy.testing.assert_allclose(numpyapi.evaluate(series.fields[1]), numpy.full((2, 4), 11.5))
+
+    @staticmethod
+    def test_select_step_counts_time_steps():
+        times = [datetime.datetime(2000, 1, 1) + datetime.timedelta(hours=6 * (i / 2)) for i in range(8)]
+        predicate = numpyapi.make_predicate(cdoapi.cdo_command.select_step_operator, [2, 4])
+        selection = [i for i, t in enumerate(times) if predicate(167, t)]
+        nose.tools.eq_(selection, [2, 3, 6, 7])
+
+    @staticmethod
+    def test_select_hours_and_zonal_max():
+        times = [datetime.datetime(2000, 1, 1) + datetime.timedelta(hours=6 * i) for i in range(8)]
+        fields = [numpy.arange(8, dtype=numpy.float32).reshape(2, 4) + i for i in range(8)]
+        series = make_series(times, fields, ("regular", 1, 4))
+        numpyapi.apply_operator(series, cdoapi.cdo_command.select + cdoapi.cdo_command.hour, [12])
+        numpyapi.apply_operator(series, cdoapi.cdo_command.zonal + cdoapi.cdo_command.max, [])
+        nose.tools.eq_([t.hour for t in series.times], [12, 12])
+        nose.tools.eq_(numpyapi.evaluate(series.fields[0]).shape, (2, 1))
+        numpy.testing.assert_allclose(numpyapi.evaluate(series.fields[1])[:, 0], [9., 13.])
+        dataset = numpyapi.create_dataset(series)
+        nose.tools.eq_(dataset.variables["var167"].shape, (2, 2, 1))
+        nose.tools.eq_(dataset.grid_descr["xsize"], 1)
+
+    @staticmethod
+    def test_monthly_max_of_daily_mean():
+        times = [datetime.datetime(2000, 1, 30) + datetime.timedelta(hours=6 * i) for i in range(16)]
+        fields = [numpy.full((2, 4), i % 5, dtype=numpy.float32) for i in range(16)]
+        series = make_series(times, fields, ("regular", 1, 4))
+        numpyapi.apply_operator(series, cdoapi.cdo_command.day + cdoapi.cdo_command.mean, [])
+        numpyapi.apply_operator(series, cdoapi.cdo_command.month + cdoapi.cdo_command.max, [])
+        nose.tools.eq_(len(series.fields), 2)
+        expected = [max(numpy.mean([j % 5 for j in range(i, i + 4)]) for i in days) for days in [[0, 4], [8, 12]]]
+        numpy.testing.assert_allclose([numpyapi.evaluate(f)[0, 0] for f in series.fields], expected)
+        nose.tools.eq_(fields[0][0, 0], 0.)
+
+    @staticmethod
+    def test_dataset_units_and_budget():
+        times = [datetime.datetime(2000, 1, 1) + datetime.timedelta(hours=6 * i) for i in range(4)]
+        fields = [numpy.full((2, 4), i, dtype=numpy.float32) for i in range(4)]
+        series = make_series(times, fields, ("regular", 1, 4))
+        series.units = "K"
+        dataset = numpyapi.create_dataset(series)
+        nose.tools.eq_(dataset.variables["var167"].units, "K")
+        numpy.testing.assert_allclose(dataset.variables["var167"][3, ...], fields[3])
+        numpyapi.memory_budget = 64
+        try:
+            nose.tools.assert_raises(ValueError, numpyapi.create_dataset, series)
+        finally:
+            numpyapi.memory_budget = None
+
+    @staticmethod
+    def test_apply_falls_back():
+        command = cdoapi.cdo_command(167)
+        command.add_operator(cdoapi.cdo_command.day + cdoapi.cdo_command.mean)
+        nose.tools.eq_(numpyapi.apply(command, ["/tmp/ece2cmor3/nonexistent.grb"], "/tmp/ece2cmor3/out.nc"), None)
+        nose.tools.eq_(numpyapi.get_dataset("/tmp/ece2cmor3/out.nc"), None)
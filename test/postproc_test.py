@@ -4,11 +4,18 @@ import unittest
 
 import nose.tools
 import test_utils
-from ece2cmor3 import cmor_source, cmor_target, cmor_task, postproc
+from ece2cmor3 import cdoapi, cmor_source, cmor_target, cmor_task, postproc
 
 logging.basicConfig(level=logging.DEBUG)
 
 
+# Task stand-in for the planning functions, which only need the target and a hashable object
+class fake_task(object):
+    def __init__(self, name):
+        self.name = name
+        self.target = cmor_target.cmor_target(name, "Amon")
+
+
 class postproc_tests(unittest.TestCase):
 
     @staticmethod
@@ -112,3 +119,62 @@ class postproc_tests(unittest.TestCase):
         nose.tools.eq_(command.create_command(), "-setgridtype,regular -setcode,118 -daymean -expr,"
                                                  "'var1=70*var39;var2=210*var40;var3=720*var41;var4=1890*var42' "
                                                  "-selcode,39,40,41,42")
+
+    @staticmethod
+    def test_shared_nodes():
+        root = ("ICMGG+199001",)
+        select, daymean, daymax = ("selcode", ("130",)), ("daymean", ()), ("daymax", ())
+        chains = [(root, (select, daymean)), (root, (select, daymean, ("monmean", ()))), (root, (select, daymax)),
+                  (("ICMSH+199001",), (select, daymean))]
+        nose.tools.eq_(postproc.get_shared_nodes(chains), [(root, (select, daymean))])
+
+    @staticmethod
+    def test_intermediate_jobs():
+        tmpdir = os.path.join(os.path.dirname(__file__), "tmp")
+        if not os.path.exists(tmpdir):
+            os.makedirs(tmpdir)
+        root = (os.path.join(tmpdir, "ICMGG+199001"),)
+        select, daymean = ("selcode", ("130",)), ("daymean", ())
+        chains = {"a": (root, (select, daymean, ("monmean", ()))), "b": (root, (select, daymean, ("monmean", ()))),
+                  "c": (root, (select, daymean, ("monmax", ()))), "d": (root, (select, ("daymax", ())))}
+
+        tasks = dict([(name, fake_task(name)) for name in chains])
+        jobs = postproc.create_intermediate_jobs(dict([(tasks[k], v) for k, v in chains.items()]), tmpdir)
+        nose.tools.eq_([job.operators for job in jobs], [(select, daymean), (("monmean", ()),)])
+        parent, child = jobs
+        nose.tools.eq_(child.parent, parent)
+        nose.tools.eq_(parent.children, [child])
+        nose.tools.eq_(sorted([t.name for t in parent.tasks]), ["c"])
+        nose.tools.eq_(sorted([t.name for t in child.tasks]), ["a", "b"])
+        nose.tools.eq_(getattr(tasks["a"], postproc.intermediate_key), (child.path, 3))
+        nose.tools.eq_(hasattr(tasks["d"], postproc.intermediate_key), False)
+        nose.tools.eq_(postproc.get_intermediate_args(child, 1), (child.operators, [parent.path], child.path, 1))
+        nose.tools.eq_(postproc.intermediates[parent.path], 2)
+        nose.tools.eq_(postproc.intermediates[child.path], 2)
+        open(parent.path, 'w').close()
+        nose.tools.eq_(postproc.finish_intermediate(parent, parent.path), (parent.tasks, [child]))
+        nose.tools.eq_(postproc.finish_intermediate(child, None), (child.tasks, []))
+        nose.tools.eq_(child.path in postproc.intermediates, False)
+        nose.tools.eq_(postproc.intermediates[parent.path], 3)
+        nose.tools.eq_(getattr(tasks["a"], postproc.intermediate_key), (parent.path, 2))
+        for name in ["a", "b", "c"]:
+            nose.tools.eq_(os.path.exists(parent.path), True)
+            postproc.release_intermediate(tasks[name])
+        nose.tools.eq_(os.path.exists(parent.path), False)
+        nose.tools.eq_(parent.path in postproc.intermediates, False)
+
+    @staticmethod
+    def test_cascade_operators():
+        root = ("ICMGG+199001",)
+        tasks = dict([(key, fake_task(key)) for key in ["daymean", "monmean", "daymax", "monmax"]])
+        commands = {}
+        for key, task in tasks.items():
+            command = cdoapi.cdo_command()
+            command.add_operator(cdoapi.cdo_command.select_code_operator, 130)
+            command.add_operator(key)
+            commands[task] = command
+        chains = dict([(task, (root, postproc.get_shared_chain(c))) for task, c in commands.items()])
+        postproc.add_cascade_operators(commands, chains)
+        nose.tools.eq_(commands[tasks["monmean"]].create_command(), "-monmean -selcode,130")
+        nose.tools.eq_(commands[tasks["monmax"]].create_command(), "-monmax -daymax -selcode,130")
+        nose.tools.eq_(chains[tasks["monmax"]][1][:2], chains[tasks["daymax"]][1])
@@ -3,6 +3,7 @@ import os
 import json
 import logging
 import unittest
+import numpy
 from nose.tools import eq_, ok_
 
 from ece2cmor3 import taskloader, ece2cmorlib, cmor_source, cmor_task, cmor_target
@@ -287,3 +288,10 @@ class taskloader_test(unittest.TestCase):
             eq_(getattr(src, "expr_order", 0), 1)
         finally:
             ece2cmorlib.finalize_without_cmor()
+
+    @staticmethod
+    def test_parse_maskexpr():
+        src, func, val = taskloader.parse_maskexpr("var172 >= 0.5")
+        eq_(src, "172.128")
+        eq_(val, 0.5)
+        eq_(func(numpy.array([[0.2, 0.5], [0.7, 0.]]), val).tolist(), [[False, True], [True, False]])